@@ -0,0 +1,369 @@
+# Starts a local server and simulated Wallaby controllers (random sensor
+# values) as separate processes and measures the whole relay path over real
+# websockets using in-process editor clients. Results are written as JSON so
+# runs of different versions can be diffed.
+#
+# Usage (from the repository root):
+# python3 -m Benchmarks.Cluster [--wallabies N] [--editors M] [--output FILE]
+import fl0w
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+
+from Highway import Client, Route, Pipe
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+EDITOR = 1
+WALLABY = 2
+
+STREAM_PROGRAM = "#!/bin/sh\nyes 'Hello from the botball program!' | head -c %d\n"
+
+
+def percentile(values, percentile):
+	if not values:
+		return None
+	values = sorted(values)
+	return values[min(len(values) - 1, int(len(values) * percentile / 100))]
+
+
+def summarize(values, scale=1000):
+	return {"count" : len(values),
+		"p50_ms" : percentile(values, 50) * scale if values else None,
+		"p99_ms" : percentile(values, 99) * scale if values else None,
+		"max_ms" : max(values) * scale if values else None}
+
+
+def get_free_port():
+	sock = socket.socket()
+	sock.bind(("127.0.0.1", 0))
+	port = sock.getsockname()[1]
+	sock.close()
+	return port
+
+
+def wait_for(condition, timeout):
+	deadline = time.time() + timeout
+	while not condition():
+		if time.time() > deadline:
+			return False
+		time.sleep(0.01)
+	return True
+
+
+class Peers(Route):
+	def run(self, data, handler):
+		handler.peer_list = data
+
+
+class WhoAmI(Route):
+	def run(self, data, handler):
+		handler.id_ = data["id"]
+
+
+class Stats(Route):
+	def run(self, data, handler):
+		handler.stats = data
+
+
+class Processes(Pipe):
+	def run(self, data, peer, handler):
+		handler.piped += 1
+		handler.last_piped = time.perf_counter()
+
+
+class Sensor(Pipe):
+	def run(self, data, peer, handler):
+		handler.readouts.append((time.perf_counter(), peer, json.dumps(data, sort_keys=True)))
+
+
+class StdStream(Pipe):
+	def run(self, data, peer, handler):
+		if type(data) is str:
+			handler.streamed[peer] = handler.streamed.get(peer, 0) + len(data.encode())
+		elif type(data) is dict:
+			handler.stream_results[peer] = (time.perf_counter(), data)
+
+
+class Editor(Client):
+	def setup(self, debug=False):
+		super().setup({"peers" : Peers(), "whoami" : WhoAmI(), "stats" : Stats(),
+			"processes" : Processes(), "sensor" : Sensor(), "std_stream" : StdStream()},
+			debug=debug)
+		self.connected = threading.Event()
+		self.id_ = None
+		self.peer_list = {}
+		self.stats = None
+		self.piped = 0
+		self.last_piped = None
+		self.readouts = []
+		self.streamed = {}
+		self.stream_results = {}
+
+
+	def ready(self):
+		self.send({"channel" : EDITOR, "name" : "benchmark"}, "subscribe")
+		self.send({"subscribe" : [EDITOR, WALLABY]}, "peers")
+		self.send(None, "whoami")
+		self.connected.set()
+
+
+	def get_peers(self, channel):
+		return sorted(id_ for id_, peer in dict(self.peer_list).items()
+			if peer["channel"] == channel)
+
+
+class StormClient(Client):
+	def setup(self):
+		super().setup({})
+		self.connected = threading.Event()
+
+
+	def ready(self):
+		self.connected.set()
+
+
+class Cluster:
+	def __init__(self, folder, wallabies, stream_bytes):
+		self.folder = folder
+		self.port = get_free_port()
+		self.address = "ws://127.0.0.1:%d" % self.port
+		self.processes = []
+		open(os.path.join(folder, "server.cfg"), "w").write(
+			"server_address = ('127.0.0.1', %d)\ndebug = False\nlog_level = 'warning'\n"
+			"source_poll_interval = 0\n" % self.port)
+		programs = os.path.join(folder, "programs")
+		os.makedirs(os.path.join(programs, "stream"))
+		program = os.path.join(programs, "stream", "botball_user_program")
+		open(program, "w").write(STREAM_PROGRAM % stream_bytes)
+		os.chmod(program, 0o755)
+		self.start("Server.py")
+		if not wait_for(self.is_listening, 10):
+			raise RuntimeError("server did not start")
+		# Every Wallaby needs its own identity, otherwise they replace each other
+		for i in range(wallabies):
+			wallaby_folder = os.path.join(folder, "wallaby%d" % i)
+			os.makedirs(wallaby_folder)
+			open(os.path.join(wallaby_folder, "wallaby.cfg"), "w").write(
+				"server_address = '%s'\ndebug = False\nidentity = 'cluster-wallaby-%d'\n" % (
+				self.address, i))
+			self.start("Wallaby.py", programs, cwd=wallaby_folder)
+
+
+	def start(self, script, *args, cwd=None):
+		env = dict(os.environ)
+		env["PYTHONPATH"] = os.pathsep.join(path for path in (env.get("PYTHONPATH"),
+			ROOT, os.path.join(ROOT, "Shared")) if path)
+		self.processes.append(subprocess.Popen([sys.executable, os.path.join(ROOT, script)] +
+			list(args), cwd=cwd or self.folder, env=env, stdout=subprocess.DEVNULL,
+			stderr=open(os.path.join(cwd or self.folder, "%s.log" % script), "a")))
+
+
+	def is_listening(self):
+		try:
+			socket.create_connection(("127.0.0.1", self.port), timeout=0.1).close()
+			return True
+		except OSError:
+			return False
+
+
+	def connect_editor(self):
+		editor = Editor(self.address)
+		editor.setup()
+		editor.connect()
+		threading.Thread(target=editor.run_forever, daemon=True).start()
+		if not editor.connected.wait(10) or not wait_for(lambda: editor.id_ != None, 10):
+			raise RuntimeError("editor could not connect")
+		return editor
+
+
+	def stop(self):
+		for process in self.processes:
+			process.terminate()
+		for process in self.processes:
+			try:
+				process.wait(5)
+			except subprocess.TimeoutExpired:
+				process.kill()
+
+
+# Every editor pipes messages to the next one, all at the same time
+def measure_pipe_throughput(editors, messages, payload_size):
+	payload = "x" * payload_size
+	for editor in editors:
+		editor.piped = 0
+	start = time.perf_counter()
+	threads = []
+	for i, editor in enumerate(editors):
+		destination = editors[(i + 1) % len(editors)].id_
+		thread = threading.Thread(target=lambda editor=editor, destination=destination: [
+			editor.pipe(payload, "processes", destination) for _ in range(messages)])
+		thread.start()
+		threads.append(thread)
+	for thread in threads:
+		thread.join()
+	complete = wait_for(lambda: all(editor.piped >= messages for editor in editors), 60)
+	end = max(editor.last_piped or start for editor in editors)
+	received = sum(editor.piped for editor in editors)
+	return {"messages" : messages * len(editors), "received" : received,
+		"payload_bytes" : payload_size, "complete" : complete,
+		"seconds" : end - start, "messages_per_second" : received / (end - start)}
+
+
+# Every readout is multicast to all subscribers, the spread is the time between
+# the first and the last editor receiving the same readout
+def measure_sensor_fanout(editors, wallabies, duration, poll_rate):
+	subscription = {"subscribe" : {"analog" : list(range(6)), "digital" : list(range(10))}}
+	first_readouts = []
+	for editor in editors:
+		editor.readouts = []
+	subscribed = time.perf_counter()
+	for editor in editors:
+		for wallaby in wallabies:
+			editor.pipe({"poll_rate" : poll_rate}, "sensor", wallaby)
+			editor.pipe(subscription, "sensor", wallaby)
+	time.sleep(duration)
+	for editor in editors:
+		for wallaby in wallabies:
+			editor.pipe("unsubscribe", "sensor", wallaby)
+	time.sleep(poll_rate * 2)
+	arrivals = {}
+	for editor in editors:
+		readouts = list(editor.readouts)
+		for wallaby in wallabies:
+			times = [arrival for arrival, peer, _ in readouts if peer == wallaby]
+			if times:
+				first_readouts.append(times[0] - subscribed)
+		for arrival, peer, readout in readouts:
+			arrivals.setdefault((peer, readout), []).append(arrival)
+	spreads = [max(times) - min(times) for times in arrivals.values()
+		if len(times) == len(editors)]
+	received = sum(len(editor.readouts) for editor in editors)
+	return {"readouts" : received,
+		"readouts_per_second_per_editor" : received / len(editors) / duration,
+		"first_readout" : summarize(first_readouts), "fanout_spread" : summarize(spreads)}
+
+
+def measure_stdout_streaming(editor, wallabies, stream_bytes):
+	editor.streamed = {}
+	editor.stream_results = {}
+	start = time.perf_counter()
+	for wallaby in wallabies:
+		editor.pipe("stream", "run_program", wallaby)
+	complete = wait_for(lambda: len(editor.stream_results) == len(wallabies), 120)
+	results = dict(editor.stream_results)
+	end = max([result[0] for result in results.values()] or [time.perf_counter()])
+	received = sum(editor.streamed.values())
+	return {"programs" : len(wallabies), "bytes_per_program" : stream_bytes,
+		"received_bytes" : received, "complete" : complete,
+		"dropped_bytes" : sum(result[1].get("dropped", 0) for result in results.values()),
+		"seconds" : end - start, "bytes_per_second" : received / (end - start)}
+
+
+def measure_connection_storm(address, connections, timeout=30):
+	clients = []
+	ready_times = []
+	lock = threading.Lock()
+	start = time.perf_counter()
+
+	def connect():
+		client = StormClient(address)
+		client.setup()
+		with lock:
+			clients.append(client)
+		try:
+			client.connect()
+		except Exception:
+			return
+		threading.Thread(target=client.run_forever, daemon=True).start()
+		if client.connected.wait(timeout):
+			with lock:
+				ready_times.append(time.perf_counter() - start)
+
+	threads = [threading.Thread(target=connect) for _ in range(connections)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	for client in clients:
+		try:
+			client.close()
+		except Exception:
+			pass
+	wait_for(lambda: all(client.terminated for client in clients), 5)
+	return {"connections" : connections, "connected" : len(ready_times),
+		"seconds" : max(ready_times) if ready_times else None,
+		"time_to_ready" : summarize(ready_times)}
+
+
+def get_version():
+	try:
+		return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT,
+			stderr=subprocess.DEVNULL).decode().strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+def run(arguments):
+	results = {"version" : get_version(), "time" : time.time(),
+		"python" : platform.python_version(), "parameters" : vars(arguments), "results" : {}}
+	with tempfile.TemporaryDirectory() as folder:
+		cluster = Cluster(folder, arguments.wallabies, arguments.stream_bytes)
+		try:
+			editors = [cluster.connect_editor() for _ in range(arguments.editors)]
+			if not wait_for(lambda: all(len(editor.get_peers(WALLABY)) == arguments.wallabies
+				for editor in editors), 30):
+				raise RuntimeError("not all Wallaby controllers connected")
+			wallabies = editors[0].get_peers(WALLABY)
+			benchmarks = (("pipe_throughput", lambda: measure_pipe_throughput(editors,
+					arguments.messages, arguments.payload_size)),
+				("sensor_fanout", lambda: measure_sensor_fanout(editors, wallabies,
+					arguments.duration, arguments.poll_rate)),
+				("stdout_streaming", lambda: measure_stdout_streaming(editors[0], wallabies,
+					arguments.stream_bytes)),
+				("connection_storm", lambda: measure_connection_storm(cluster.address,
+					arguments.connections)))
+			for name, benchmark in benchmarks:
+				results["results"][name] = benchmark()
+				print("%s: %s" % (name, json.dumps(results["results"][name])))
+			editors[0].stats = None
+			editors[0].send(None, "stats")
+			if wait_for(lambda: editors[0].stats != None, 5):
+				results["results"]["server_routes"] = {direction : {route :
+					{"messages" : metrics["messages"], "bytes" : metrics["bytes"]}
+					for route, metrics in routes.items()}
+					for direction, routes in editors[0].stats["routes"].items()}
+			for editor in editors:
+				editor.close()
+			wait_for(lambda: all(editor.terminated for editor in editors), 5)
+		finally:
+			cluster.stop()
+	json.dump(results, open(arguments.output, "w"), indent=4, sort_keys=True)
+	print("Results written to '%s'." % arguments.output)
+	return results
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="fl0w relay benchmark")
+	parser.add_argument("--wallabies", type=int, default=4)
+	parser.add_argument("--editors", type=int, default=4)
+	parser.add_argument("--messages", type=int, default=2000,
+		help="messages every editor pipes to the next one")
+	parser.add_argument("--payload-size", type=int, default=64)
+	parser.add_argument("--duration", type=float, default=5,
+		help="seconds of sensor readouts")
+	parser.add_argument("--poll-rate", type=float, default=0.1)
+	parser.add_argument("--stream-bytes", type=int, default=2**20,
+		help="output of every streamed program")
+	parser.add_argument("--connections", type=int, default=200,
+		help="connections opened at once during the storm")
+	parser.add_argument("--output", default="benchmark-results.json")
+	run(parser.parse_args())
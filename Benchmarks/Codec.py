@@ -0,0 +1,123 @@
+# Micro-benchmarks for the functions every frame goes through, for every
+# payload type in DATA_TYPES at several sizes and with both codecs.
+# Reports ns/op and the peak memory allocated by a single call.
+#
+# Usage (from the repository root):
+# python3 -m Benchmarks.Codec [--filter TEXT] [--quick] [--output FILE]
+import fl0w
+
+import json
+import time
+import argparse
+import tracemalloc
+
+from Highway import (CODECS, METADATA_LENGTH, prepare_data, convert_data,
+	pack_message, pack_pipe_src_message, pack_forwarded_pipe_message,
+	parse_metadata, parse_pipe_src_metadata)
+
+ROUTE = 3
+PIPE_ID = "a1b2c3d4"
+
+SIZES = (16, 1024, 65536)
+CONTAINER_SIZES = (10, 100, 1000)
+
+
+def get_payloads():
+	payloads = []
+	for size in SIZES:
+		payloads.append(("str", size, "x" * size, False))
+		payloads.append(("bytes", size, b"x" * size, False))
+	for size in CONTAINER_SIZES:
+		payloads.append(("list", size, ["root %d 0.0 0.1 2136 644 ? Ss 0:01 init" % i
+			for i in range(size)], False))
+		payloads.append(("dict", size, {"port%d" % i : {"value" : i, "name" : "analog"}
+			for i in range(size)}, False))
+		payloads.append(("indexed_dict", size, {i : i * 3 for i in range(size)}, True))
+	payloads.append(("int", 1, 1337, False))
+	payloads.append(("float", 1, 13.37, False))
+	payloads.append(("None", 1, None, False))
+	return payloads
+
+
+def get_operations(data, indexed_dict, codec):
+	message = pack_message(data, ROUTE, indexed_dict=indexed_dict, codec=codec)
+	data_type = parse_metadata(message)[0]
+	payload = message[METADATA_LENGTH:]
+	pipe_message = pack_pipe_src_message(data, ROUTE, PIPE_ID,
+		indexed_dict=indexed_dict, codec=codec)
+	return (("prepare_data", lambda: prepare_data(data, codec=codec)),
+		("convert_data", lambda: convert_data(payload, data_type)),
+		("pack_message", lambda: pack_message(data, ROUTE, indexed_dict=indexed_dict,
+			codec=codec)),
+		("pack_pipe_src_message", lambda: pack_pipe_src_message(data, ROUTE, PIPE_ID,
+			indexed_dict=indexed_dict, codec=codec)),
+		("parse_metadata", lambda: parse_metadata(message)),
+		("parse_pipe_src_metadata", lambda: parse_pipe_src_metadata(pipe_message)),
+		("pack_forwarded_pipe_message", lambda: pack_forwarded_pipe_message(pipe_message,
+			ROUTE, PIPE_ID)))
+
+
+# Repeats the operation until min_time has passed, the best of repeat runs counts
+def measure_time(operation, min_time, repeat):
+	loops = 1
+	while True:
+		start = time.perf_counter_ns()
+		for _ in range(loops):
+			operation()
+		elapsed = time.perf_counter_ns() - start
+		if elapsed >= min_time * 1e9:
+			break
+		loops *= 2 if elapsed == 0 else max(2, min(10, int(min_time * 1e9 / elapsed) + 1))
+	best = elapsed
+	for _ in range(repeat - 1):
+		start = time.perf_counter_ns()
+		for _ in range(loops):
+			operation()
+		best = min(best, time.perf_counter_ns() - start)
+	return best / loops
+
+
+# CPython does not count allocations, the peak traced memory of a single call
+# is the closest measure
+def measure_allocations(operation):
+	operation()
+	tracemalloc.start()
+	try:
+		before = tracemalloc.get_traced_memory()[0]
+		tracemalloc.reset_peak()
+		operation()
+		return tracemalloc.get_traced_memory()[1] - before
+	finally:
+		tracemalloc.stop()
+
+
+def run(filter_=None, min_time=0.05, repeat=3):
+	results = []
+	print("%-28s %-6s %-13s %6s %14s %12s" % ("operation", "codec", "type", "size",
+		"ns/op", "alloc bytes"))
+	for codec in CODECS:
+		for name, size, data, indexed_dict in get_payloads():
+			for operation_name, operation in get_operations(data, indexed_dict, codec):
+				label = "%s %s %s" % (operation_name, codec, name)
+				if filter_ != None and filter_ not in label:
+					continue
+				result = {"operation" : operation_name, "codec" : codec, "type" : name,
+					"size" : size, "ns_per_op" : measure_time(operation, min_time, repeat),
+					"alloc_bytes" : measure_allocations(operation)}
+				results.append(result)
+				print("%-28s %-6s %-13s %6d %14.0f %12d" % (operation_name, codec, name,
+					size, result["ns_per_op"], result["alloc_bytes"]))
+	return results
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Highway pack/parse micro-benchmarks")
+	parser.add_argument("--filter", help="only run operations whose "
+		"'operation codec type' label contains this text")
+	parser.add_argument("--quick", action="store_true", help="shorter, noisier measurements")
+	parser.add_argument("--output", help="write results as JSON")
+	arguments = parser.parse_args()
+	results = run(arguments.filter, min_time=0.01 if arguments.quick else 0.05,
+		repeat=1 if arguments.quick else 3)
+	if arguments.output != None:
+		json.dump(results, open(arguments.output, "w"), indent=4)
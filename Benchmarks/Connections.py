@@ -0,0 +1,80 @@
+# Memory used by simulated server connections. Every connection is a Server
+# handler on one end of a socket pair that went through the meta handshake of
+# a Wallaby. Compares handlers that share their route tables with handlers
+# that each build their own (as every handler did before tables were shared).
+#
+# Usage (from the repository root):
+# python3 -m Benchmarks.Connections [--connections N] [--output FILE]
+import fl0w
+
+import gc
+import json
+import socket
+import argparse
+import tracemalloc
+
+from Highway import (Server, PeerRegistry, RouteCache, DummyPipe, META_ROUTE, CODEC_BINARY,
+	create_exchange_map, compact_exchange_map, get_exchange_map_hash)
+
+# Same routes as Server/Server.py and Wallaby/Wallaby.py
+SERVER_ROUTES = ("info", "whoami", "compile", "sources", "stats", "subscribe", "hostname",
+	"processes", "peers", "sensor", "identify", "list_programs", "run_program", "std_stream",
+	"stop_programs", "shutdown", "reboot")
+WALLABY_ROUTES = ("subscribe", "hostname", "processes", "sensor", "identify",
+	"list_programs", "whoami", "run_program", "stop_programs", "shutdown", "reboot",
+	"pipe", "meta", "batch")
+
+
+def connect(routes, registry, route_cache, port):
+	server_sock, client_sock = socket.socketpair()
+	handler = Server(server_sock, environ={})
+	handler.setup(routes, registry, route_cache=route_cache)
+	handler.address, handler.port = "127.0.0.1", port
+	handler.post_opened()
+	exchange_map = create_exchange_map(WALLABY_ROUTES)
+	handler.routes[META_ROUTE].run({"routes" : compact_exchange_map(exchange_map),
+		"routes_hash" : get_exchange_map_hash(exchange_map), "codec" : CODEC_BINARY,
+		"heartbeat" : True}, handler)
+	return handler, client_sock
+
+
+def measure(connections, shared):
+	routes = {route : DummyPipe() for route in SERVER_ROUTES}
+	registry = PeerRegistry()
+	route_cache = RouteCache() if shared else None
+	gc.collect()
+	tracemalloc.start()
+	try:
+		before = tracemalloc.get_traced_memory()[0]
+		handlers = [connect(routes if shared else dict(routes), registry, route_cache,
+			port) for port in range(connections)]
+		gc.collect()
+		used = tracemalloc.get_traced_memory()[0] - before
+	finally:
+		tracemalloc.stop()
+	for handler, client_sock in handlers:
+		handler.outbound.stop()
+		handler.sock.close()
+		client_sock.close()
+	return used
+
+
+def run(connections=500):
+	results = {}
+	for label, shared in (("per handler tables", False), ("shared tables", True)):
+		used = measure(connections, shared)
+		results[label] = {"connections" : connections, "bytes" : used,
+			"bytes_per_connection" : used / connections}
+		print("%-20s %5d connections: %8.1f KiB (%6.0f bytes/connection)" % (label,
+			connections, used / 1024, used / connections))
+	return results
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Memory used by server connections")
+	parser.add_argument("--connections", type=int, default=500)
+	parser.add_argument("--output", help="write results as JSON")
+	arguments = parser.parse_args()
+	results = run(arguments.connections)
+	if arguments.output != None:
+		json.dump(results, open(arguments.output, "w"), indent=4)
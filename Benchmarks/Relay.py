@@ -0,0 +1,68 @@
+# Measures how many piped messages per second ServerPipe can relay.
+# No sockets are involved, the endpoints only count the bytes they would send.
+#
+# Usage (from the repository root): python3 -m Benchmarks.Relay [messages]
+import fl0w
+
+import sys
+import time
+
+from Highway import (Shared, ServerPipe, DummyPipe, PIPE_ROUTE, CODECS,
+	pack_pipe_src_message, parse_pipe_src_metadata)
+
+
+PAYLOADS = {"sensor" : {"analog" : {0 : 1240, 1 : 3011}, "digital" : {0 : 0, 9 : 1}},
+	"std_stream" : "Hello from the botball program! Loop #1337\n",
+	"processes" : ["root       1  0.0  0.1   2136   644 ?        Ss   Jan01   0:01 init"] * 60}
+
+
+class Endpoint(Shared):
+	def __init__(self, id_, codec):
+		self.setup({route : DummyPipe() for route in PAYLOADS})
+		self.routes[PIPE_ROUTE] = ServerPipe()
+		# Both ends share the same route table
+		self.peer_exchange_routes = self.exchange_routes
+		self.peer_reverse_exchange_routes = self.reverse_exchange_routes
+		self.id_ = id_
+		self.codec = codec
+		self.address, self.port = "127.0.0.1", 0
+		self.peers = {}
+		self.sent = 0
+		self.override_methods()
+
+
+	def send(self, message, binary=False):
+		self.sent += len(message)
+
+
+def measure(relay, messages):
+	start = time.perf_counter()
+	for _ in range(messages):
+		relay()
+	return messages / (time.perf_counter() - start)
+
+
+def run(messages=20000):
+	results = {}
+	for codec in CODECS:
+		source = Endpoint("aaaaaaaa", codec)
+		destination = Endpoint("bbbbbbbb", codec)
+		source.peers[destination.id_] = destination
+		pipe = source.routes[PIPE_ROUTE]
+		for route, payload in PAYLOADS.items():
+			message = pack_pipe_src_message(payload,
+				source.peer_reverse_exchange_routes[route], destination.id_,
+				codec=codec)
+			data_type = parse_pipe_src_metadata(message)[0]
+			# Decoding and re-encoding the payload is what the relay used to do
+			before = measure(lambda: pipe.transcode(message, data_type, route,
+				destination, source), messages)
+			after = measure(lambda: pipe.run(message, source), messages)
+			results[(codec, route)] = (before, after)
+			print("%-6s %-10s decode/re-encode: %9.0f msg/s  forward: %9.0f msg/s  (x%.1f)" % (
+				codec, route, before, after, after / before))
+	return results
+
+
+if __name__ == "__main__":
+	run(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
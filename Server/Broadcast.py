@@ -1,47 +1,75 @@
+import Logging
+
+from Highway import pack_message
+
+
 class Broadcast:
 	class ChannelError(IndexError):
 		def __init__(self, channel):
 			super(Broadcast.ChannelError, self).__init__("channel '%s' does not exist" % channel)
 
 	def __init__(self):
+		# Channel members are kept in dicts (insertion ordered sets)
 		self.channels = {}
+		self.stats = {}
 
-	def broadcast(self, data, route, channel, exclude=[]):
+	def broadcast(self, data, route, channel, exclude=()):
 		if channel in self.channels:
-			for handler in self.channels[channel]:
+			exclude = set(exclude)
+			stats = self.stats[channel]
+			# Route ids, codecs and compression are negotiated per peer, every combination
+			# is only encoded once
+			messages = {}
+			stats["broadcasts"] += 1
+			for handler in list(self.channels[channel]):
 				if not handler in exclude:
-					handler.send(data, route)
+					try:
+						key = (handler.peer_reverse_exchange_routes[route], handler.codec,
+							handler.get_compression())
+					except KeyError:
+						Logging.error("'%s' is not a valid peer route." % route)
+						continue
+					if key not in messages:
+						messages[key] = pack_message(data, key[0], codec=key[1],
+							compression=key[2])
+						stats["encodes"] += 1
+					handler.send_packed(messages[key], route)
+					stats["sends"] += 1
+					stats["bytes"] += len(messages[key])
 		else:
 			raise Broadcast.ChannelError(channel)
 
 	def remove(self, handler, channel):
 		if channel in self.channels:
-			if handler in self.channels[channel]:
-				del self.channels[channel][self.channels[channel].index(handler)]
+			self.channels[channel].pop(handler, None)
 		else:
 			raise Broadcast.ChannelError(channel)
 
 	def add(self, handler, channel):
 		if channel in self.channels:
-			if not handler in self.channels[channel]:
-				self.channels[channel].append(handler)
+			self.channels[channel][handler] = None
 		else:
 			raise Broadcast.ChannelError(channel)
 
 	def add_channel(self, channel):
-		self.channels[channel] = []
+		self.channels[channel] = {}
+		self.stats[channel] = {"broadcasts" : 0, "encodes" : 0, "sends" : 0, "bytes" : 0}
 
 	def remove_channel(self, channel):
 		if channel in self.channels:
 			del self.channels[channel]
+			del self.stats[channel]
 		else:
 			raise Broadcast.ChannelError(channel)
 
 	def __repr__(self):
 		out = "Channels:\n"
 		for channel in self.channels:
-			out += "%s: %d socks\n" % (channel, len(self.channels[channel]))
+			out += "%s: %d socks, %d broadcasts, %d encodes, %d sends, %d bytes\n" % (
+				channel, len(self.channels[channel]), self.stats[channel]["broadcasts"],
+				self.stats[channel]["encodes"], self.stats[channel]["sends"],
+				self.stats[channel]["bytes"])
 		return out.rstrip("\n")
 
 	def __str__(self):
-		return self.__repr__()
\ No newline at end of file
+		return self.__repr__()
@@ -0,0 +1,191 @@
+import Logging
+
+import os
+import shutil
+import platform
+import hashlib
+import threading
+from collections import deque, OrderedDict
+from subprocess import Popen, PIPE
+
+
+class Job:
+	def __init__(self, key, source, relpath, command):
+		self.key = key
+		self.source = source
+		self.relpath = relpath
+		self.command = command
+		self.callbacks = []
+
+
+class Compiler:
+	CACHE_FOLDER = ".cache"
+	BINARY_NAME = "botball_user_program"
+
+	def __init__(self, index, binary_path, workers=1, cache_size=256):
+		self.index = index
+		self.source_path = index.source_path
+		self.binary_path = os.path.abspath(binary_path) + "/"
+		self.cache_path = self.binary_path + Compiler.CACHE_FOLDER + "/"
+		# binary_path is only created by the config validator if it is set
+		os.makedirs(self.cache_path, exist_ok=True)
+		self.wallaby_library_avaliable = os.path.isfile("/usr/local/lib/libaurora.so") and os.path.isfile("/usr/local/lib/libdaylite.so")
+		if not self.wallaby_library_avaliable:
+			Logging.warning("Wallaby library not found. All Wallaby functions are unavaliable.")
+		if platform.machine() != "armv7l":
+			Logging.warning("Wrong processor architecture! Generated binaries will not run on Wallaby Controllers.")
+		self.flags = ["-pipe", "-O0", "-I%s" % self.source_path]
+		self.libraries = ["-lwallaby"] if self.wallaby_library_avaliable else []
+		# key -> (failed, returned), least recently used first
+		self.cache = OrderedDict()
+		self.cache_size = cache_size
+		self.hits = 0
+		self.misses = 0
+		self.pending = deque()
+		# Jobs by key, so identical requests share a single gcc run
+		self.jobs = {}
+		self.condition = threading.Condition()
+		self._load_cache()
+		for i in range(workers):
+			worker = threading.Thread(target=self._worker)
+			worker.daemon = True
+			worker.start()
+
+
+	# Source, local headers and flags decide what gcc produces
+	def get_key(self, path, entry):
+		hash_ = hashlib.sha256()
+		hash_.update(" ".join(self.flags + self.libraries).encode())
+		hash_.update(entry.hash.encode())
+		for include_path in sorted(self.index.get_dependencies(path)):
+			include = self.index.get(include_path)
+			if include != None:
+				hash_.update(include_path.encode())
+				hash_.update(include.hash.encode())
+		return hash_.hexdigest()
+
+
+	def get_binary_folder(self, relpath):
+		return self.binary_path + "-".join(relpath.split("/"))[:-len(".c")]
+
+
+	# Calls callback with {"failed", "returned", "relpath", "cached"} once the
+	# program is compiled. Returns the queue position or None if the result
+	# was already known.
+	def compile(self, relpath, callback):
+		path = os.path.abspath(self.source_path + relpath)
+		entry = self.index.get(path) if relpath.endswith(".c") else None
+		if entry == None:
+			callback({"failed" : True, "returned" : "'%s' is not a C source file." % relpath,
+				"relpath" : relpath, "cached" : False})
+			return None
+		if not entry.has_main:
+			callback({"failed" : True, "returned" : "'%s' has no main function." % relpath,
+				"relpath" : relpath, "cached" : False})
+			return None
+		key = self.get_key(path, entry)
+		with self.condition:
+			if key in self.cache and (self.cache[key][0] or os.path.isfile(self.cache_path + key)):
+				self.cache.move_to_end(key)
+				self.hits += 1
+				failed, returned = self.cache[key]
+			else:
+				if key in self.jobs:
+					job = self.jobs[key]
+				else:
+					self.misses += 1
+					job = Job(key, path, relpath, ["gcc"] + self.flags + [path] +
+						self.libraries + ["-o", self.cache_path + key + ".tmp"])
+					self.jobs[key] = job
+					self.pending.append(job)
+					self.condition.notify()
+				job.callbacks.append((relpath, callback))
+				# 0 means gcc is already running
+				return self.pending.index(job) + 1 if job in self.pending else 0
+		# Copied without holding the lock, like binaries of finished jobs
+		if not failed:
+			try:
+				self.install(key, relpath)
+			except OSError as e:
+				failed, returned = True, "Unable to install binary: %s" % e
+		callback({"failed" : failed, "returned" : returned, "relpath" : relpath, "cached" : True})
+		return None
+
+
+	# Keeps binaries of programs affected by source changes up to date
+	def rebuild(self, relpaths):
+		for relpath in relpaths:
+			self.compile(relpath, self._log_rebuild)
+
+
+	def _log_rebuild(self, result):
+		if result["failed"]:
+			Logging.warning("Rebuilding '%s' failed." % result["relpath"])
+		else:
+			Logging.info("Rebuilt '%s'." % result["relpath"])
+
+
+	def install(self, key, relpath):
+		folder = self.get_binary_folder(relpath)
+		if not os.path.exists(folder):
+			os.mkdir(folder)
+		shutil.copy(self.cache_path + key, folder + "/" + Compiler.BINARY_NAME)
+
+
+	# Binaries of earlier runs are still in the cache folder, the oldest are
+	# evicted first. Their gcc output is gone, so it is reported as empty.
+	def _load_cache(self):
+		binaries = []
+		for name in os.listdir(self.cache_path):
+			path = self.cache_path + name
+			if name.endswith(".tmp"):
+				# Left behind by a gcc run that was interrupted
+				try:
+					os.remove(path)
+				except OSError:
+					pass
+			elif os.path.isfile(path):
+				binaries.append((os.path.getmtime(path), name))
+		for _, key in sorted(binaries):
+			self._store(key, False, "")
+
+
+	def _store(self, key, failed, returned):
+		self.cache[key] = (failed, returned)
+		self.cache.move_to_end(key)
+		while len(self.cache) > self.cache_size:
+			evicted, (evicted_failed, _) = self.cache.popitem(last=False)
+			if not evicted_failed:
+				try:
+					os.remove(self.cache_path + evicted)
+				except OSError:
+					pass
+
+
+	def _worker(self):
+		while True:
+			with self.condition:
+				while not self.pending:
+					self.condition.wait()
+				job = self.pending.popleft()
+			try:
+				p = Popen(job.command, stdout=PIPE, stderr=PIPE)
+				returned = "".join(output.decode(errors="replace") for output in p.communicate())
+				failed = p.returncode != 0
+			except OSError as e:
+				returned = "Unable to run gcc: %s" % e
+				failed = True
+			if not failed:
+				os.replace(self.cache_path + job.key + ".tmp", self.cache_path + job.key)
+			with self.condition:
+				self._store(job.key, failed, returned)
+				del self.jobs[job.key]
+				callbacks = job.callbacks
+			for relpath, callback in callbacks:
+				try:
+					if not failed:
+						self.install(job.key, relpath)
+					callback({"failed" : failed, "returned" : returned,
+						"relpath" : relpath, "cached" : False})
+				except Exception as e:
+					Logging.error("Compile callback for '%s' failed: %s" % (relpath, e))
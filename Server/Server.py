@@ -1,22 +1,27 @@
 import Logging
 import Config
+import Metrics
 
 from .Broadcast import Broadcast
+from .Compile import Compiler
+from .SourceIndex import SourceIndex
 
 import json
 import os
 import subprocess
-import re
 import pwd
-import platform
 import struct
-from subprocess import Popen, PIPE
+import threading
+from socketserver import ThreadingMixIn
 
 from wsgiref.simple_server import make_server
 from ws4py.server.wsgirefserver import WSGIServer, WebSocketWSGIRequestHandler
 from ws4py.server.wsgiutils import WebSocketWSGIApplication
 
-from Highway import Server, Route, DummyPipe
+from Highway import (Server, Route, DummyPipe, PeerRegistry, COMPRESSION_LEVEL,
+	COMPRESSION_THRESHOLD, OUTBOUND_HIGH_WATERMARK, OUTBOUND_LOW_WATERMARK,
+	DROP_OLDEST, NEVER_DROP, SESSION_TIMEOUT, HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT,
+	META_ROUTE, RouteCache)
 
 
 class Info(Route):
@@ -24,45 +29,85 @@ class Info(Route):
 		handler.send({"routes" : list(handler.routes.keys())}, "info")
 
 
-class Compile:
-	HAS_MAIN = re.compile(r"\w*\s*main\(\)\s*(\{|.*)$")
+class Compile(Route):
+	"""
+	"relpath/to/program.c"
+	{"relpath" : "relpath/to/program.c"}
 
-	@staticmethod
-	def is_valid_c_program(path):
-		for line in open(path, "r").read().split("\n"):
-			if Compile.HAS_MAIN.match(line):
-				return True
-		return False
+	Replies with the queue position unless the result is already known:
+	{"relpath" : "...", "position" : 2}
+	{"relpath" : "...", "failed" : False, "returned" : "...", "cached" : True}
+	"""
+	# Hashing sources for the cache key can take a while
+	blocking = True
+	workers = 4
 
+	def __init__(self, compiler):
+		self.compiler = compiler
 
-	def __init__(self, source_path, binary_path):
-		self.source_path = os.path.abspath(source_path) + "/"
-		self.binary_path = os.path.abspath(binary_path) + "/"
-		self.wallaby_library_avaliable = os.path.isfile("/usr/local/lib/libaurora.so") and os.path.isfile("/usr/local/lib/libdaylite.so")
-		if not self.wallaby_library_avaliable:
-			Logging.warning("Wallaby library not found. All Wallaby functions are unavaliable.")
-		if platform.machine() != "armv7l":
-			Logging.warning("Wrong processor architecture! Generated binaries will not run on Wallaby Controllers.")
+	def run(self, data, handler):
+		if type(data) is dict:
+			data = data.get("relpath")
+		if type(data) is str:
+			route = handler.reverse_routes[self]
+			position = self.compiler.compile(data,
+				lambda result: self.send_result(result, route, handler))
+			if position != None:
+				handler.send({"relpath" : data, "position" : position}, route)
+			if handler.debug:
+				Logging.info("Compile request for '%s' (%d hits, %d misses)." % (data,
+					self.compiler.hits, self.compiler.misses))
+
+
+	def send_result(self, result, route, handler):
+		try:
+			handler.send(result, route)
+		except RuntimeError:
+			pass
 
 
-	def compile(self, path, relpath, handler=None):
-		if relpath.endswith(".c") and Compile.is_valid_c_program(path + relpath):
-			name = "-".join(relpath.split("/")).rstrip(".c")
-			full_path = self.binary_path + name
-			if not os.path.exists(full_path):
-				os.mkdir(full_path)
-			error = True
-			command = ["gcc", "-pipe", "-O0", "-lwallaby", "-I%s" % self.source_path, "-o", "%s" % full_path + "/botball_user_program", path + relpath]
-			if not self.wallaby_library_avaliable:
-				del command[command.index("-lwallaby")]
-			p = Popen(command, stdout=PIPE, stderr=PIPE)
-			error = False if p.wait() == 0 else True
-			result = ""
-			for line in p.communicate():
-				result += line.decode()
-			if handler != None:
-				handler.send({"failed" : error, "returned" : result, "relpath" : relpath}, self.handler.reverse_routes[self])
 
+class Sources(Route):
+	"""
+	Replies with all programs (sources with a main function):
+	{"programs" : ["relpath/to/program.c"]}
+	"""
+	def __init__(self, index):
+		self.index = index
+
+	def run(self, data, handler):
+		handler.send({"programs" : self.index.get_programs()}, handler.reverse_routes[self])
+
+
+class Stats(Route):
+	"""
+	Replies with message counters and latency histograms (in microseconds)
+	per route and direction since the server started:
+	{"uptime" : 12.5, "routes" : {"in" : {"pipe" : {"messages" : 10, "bytes" : 400,
+	"codec" : {...}, "handler" : {...}}}, "out" : {...}},
+	"peers" : 2, "broadcast" : {...}, "compile" : {"hits" : 1, "misses" : 2},
+	"outbound" : {"id" : {"pending" : 0, "dropped" : 0, "congested" : False}},
+	"rtt" : {"id" : 1.5}}
+	Round trip times are in ms and null until the first heartbeat returned.
+	"""
+	def __init__(self, compiler):
+		self.compiler = compiler
+
+	def run(self, data, handler):
+		stats = handler.metrics.get()
+		stats["peers"] = len(handler.peers)
+		stats["broadcast"] = handler.broadcast.stats
+		stats["compile"] = {"hits" : self.compiler.hits, "misses" : self.compiler.misses,
+			"pending" : len(self.compiler.pending)}
+		stats["outbound"] = {}
+		stats["rtt"] = {}
+		for id_ in handler.peers:
+			peer = handler.peers.get(id_)
+			if peer != None:
+				stats["rtt"][id_] = round(peer.rtt * 1000, 1) if peer.rtt != None else None
+				if peer.outbound != None:
+					stats["outbound"][id_] = peer.outbound.get()
+		handler.send(stats, handler.reverse_routes[self])
 
 
 class Subscribe(Route):
@@ -75,7 +120,9 @@ class Subscribe(Route):
 		if type(data) is dict:
 			if "channel" in data:
 				if data["channel"] in Subscribe.CHANNELS:
-					handler.channel = data["channel"]
+					if handler.channel != None:
+						handler.broadcast.remove(handler, handler.channel)
+					handler.registry.set_channel(handler, data["channel"])
 					handler.broadcast.add(handler, handler.channel)
 				if handler.debug:
 					Logging.info("'%s:%i' has identified as a %s client." % (handler.address, handler.port,
@@ -98,11 +145,23 @@ class WhoAmI(Route):
 class Peers(Route):
 	"""
 	{"subscribe" : [1, 2]}
+	{"subscribe" : [1, 2], "deltas" : True}
 	{"unsubscribe" : [1, 2]}
 	{"channels" : [1, 2]}
+
+	Delta subscribers receive a snapshot followed by changes:
+	{"seq" : 1, "peers" : {"id" : {...}}}
+	{"seq" : 2, "added" : {"id" : {...}}, "changed" : {}, "removed" : ["id"]}
 	"""
-	def __init__(self):
+	def __init__(self, update_window=0):
 		self.subscriptions = {}
+		# Last peer list every subscriber has been sent
+		self.sent = {}
+		self.sequences = {}
+		self.delta_subscribers = set()
+		self.update_window = update_window
+		self.update_scheduled = False
+		self.lock = threading.RLock()
 
 	def run(self, data, handler):
 		for event in ("subscribe", "unsubscribe", "channels"):
@@ -114,63 +173,167 @@ class Peers(Route):
 				if event == "unsubscribe":
 					for channel in channels:
 						self.unsubscribe(handler, channel)
+				elif event == "subscribe" and data.get("deltas") is True:
+					with self.lock:
+						for channel in channels:
+							self.subscribe(handler, channel)
+						self.delta_subscribers.add(handler)
+						self.send_snapshot(handler)
 				else:
 					if event == "subscribe":
 						for channel in channels:
 							self.subscribe(handler, channel)
 					# Send on channels and on subscribe
-					self.send_connected_peers(handler, channels)						
+					peers = self.send_connected_peers(handler, channels)
+					with self.lock:
+						if set(channels) == set(self.subscriptions.get(handler, ())):
+							self.sent[handler] = peers
 
 
-	def send_connected_peers(self, handler, channels):
+	def get_connected_peers(self, handler, channels):
 		out = {}
-		peers = handler.peers
-		for peer_id in peers:
-			# Only check for type inclusion if check_type is True
-			peer = peers[peer_id]
-			if peer.channel in channels:
+		for channel in channels:
+			for peer in handler.peers.in_channel(channel):
 				if peer is not handler:
-					out[peer_id] = {"name" : peer.name,
+					out[peer.id_] = {"name" : peer.name,
 					"address" : peer.address, "port" : peer.port,
 					"channel" : peer.channel}
-		handler.send(out, handler.reverse_routes[self])
+		return out
 
 
-	def subscribe(self, handler, channel):
-		if handler not in self.subscriptions:
-			self.subscriptions[handler] = [channel]
+	def send_connected_peers(self, handler, channels):
+		peers = self.get_connected_peers(handler, channels)
+		handler.send(peers, handler.reverse_routes[self])
+		return peers
+
+
+	def send_snapshot(self, handler):
+		peers = self.get_connected_peers(handler, self.subscriptions[handler])
+		self.sent[handler] = peers
+		self.sequences[handler] = self.sequences.get(handler, 0) + 1
+		handler.send({"seq" : self.sequences[handler], "peers" : peers},
+			handler.reverse_routes[self])
+
+
+	# Only sends something if the subscriber's view actually changed
+	def send_changes(self, handler, channels):
+		peers = self.get_connected_peers(handler, channels)
+		last_peers = self.sent.get(handler)
+		if peers == last_peers:
+			return
+		self.sent[handler] = peers
+		if handler in self.delta_subscribers:
+			last_peers = last_peers if last_peers != None else {}
+			self.sequences[handler] = self.sequences.get(handler, 0) + 1
+			delta = {"seq" : self.sequences[handler], "added" : {}, "changed" : {},
+				"removed" : [id_ for id_ in last_peers if id_ not in peers]}
+			for id_ in peers:
+				if id_ not in last_peers:
+					delta["added"][id_] = peers[id_]
+				elif peers[id_] != last_peers[id_]:
+					delta["changed"][id_] = peers[id_]
+			handler.send(delta, handler.reverse_routes[self])
 		else:
-			if channel not in self.subscriptions[handler]:
-				self.subscriptions[handler].append(channel)
+			handler.send(peers, handler.reverse_routes[self])
+
+
+	def subscribe(self, handler, channel):
+		with self.lock:
+			if handler not in self.subscriptions:
+				self.subscriptions[handler] = [channel]
+			else:
+				if channel not in self.subscriptions[handler]:
+					self.subscriptions[handler].append(channel)
 
 
 	def unsubscribe(self, handler, channel):
-		if handler in self.subscriptions:
-			if channel in self.subscriptions[handler]:
-				del self.subscriptions[handler][self.subscriptions[handler].index(channel)]
+		with self.lock:
+			if handler in self.subscriptions:
+				if channel in self.subscriptions[handler]:
+					del self.subscriptions[handler][self.subscriptions[handler].index(channel)]
+
+
+	def get_state(self, handler):
+		with self.lock:
+			return {"channels" : list(self.subscriptions.get(handler, ())),
+				"deltas" : handler in self.delta_subscribers}
+
+
+	# The subscriber gets the current peers since it might have missed changes
+	def restore(self, handler, state):
+		if not state["channels"]:
+			return
+		with self.lock:
+			for channel in state["channels"]:
+				self.subscribe(handler, channel)
+			if state["deltas"]:
+				self.delta_subscribers.add(handler)
+				self.send_snapshot(handler)
+			else:
+				self.sent[handler] = self.send_connected_peers(handler, state["channels"])
 
 
 	def unsubscribe_all(self, handler):
-		if handler in self.subscriptions:
-			del self.subscriptions[handler]
+		with self.lock:
+			if handler in self.subscriptions:
+				del self.subscriptions[handler]
+			self.sent.pop(handler, None)
+			self.sequences.pop(handler, None)
+			self.delta_subscribers.discard(handler)
 
 
+	# Bursts of joins and leaves within the update window are collapsed into
+	# a single update per subscriber
 	def push_changes(self, handler):
-		out = {}
+		if self.update_window > 0:
+			with self.lock:
+				if self.update_scheduled:
+					return
+				self.update_scheduled = True
+			timer = threading.Timer(self.update_window, self.flush_changes)
+			timer.daemon = True
+			timer.start()
+		else:
+			self.flush_changes()
+
+
+	def flush_changes(self):
 		to_unsubscribe = []
-		peers = handler.peers
-		for handler_ in self.subscriptions:
-			try:
-				self.send_connected_peers(handler_, self.subscriptions[handler_])
-			except RuntimeError:
-				to_unsubscribe.append(handler_)
-		for handler in to_unsubscribe:
-			self.unsubscribe_all(handler)
+		with self.lock:
+			self.update_scheduled = False
+			for handler_, channels in list(self.subscriptions.items()):
+				try:
+					self.send_changes(handler_, channels)
+				except RuntimeError:
+					to_unsubscribe.append(handler_)
+			for handler in to_unsubscribe:
+				self.unsubscribe_all(handler)
+
+
+# Sensor readouts are superseded by the next one anyway, program control
+# messages are small and must arrive. Program output and peer deltas are
+# relayed or sent under a lock, compile results from the shared route pool
+# and the gcc workers, their producers must not block. Everything else
+# blocks the producer unless it runs on the receiving thread.
+OUTBOUND_POLICIES = {"sensor" : DROP_OLDEST, "run_program" : NEVER_DROP,
+	"stop_programs" : NEVER_DROP, "std_stream" : NEVER_DROP, "peers" : NEVER_DROP,
+	"compile" : NEVER_DROP}
 
 
 class Handler(Server):
-	def setup(self, routes, broadcast, websockets, debug=False):
-		super().setup(routes, websockets, debug=debug)
+	__slots__ = ("broadcast", "channel", "name")
+
+	def setup(self, routes, broadcast, registry, debug=False,
+		compression_level=COMPRESSION_LEVEL, compression_threshold=COMPRESSION_THRESHOLD,
+		outbound_high_watermark=OUTBOUND_HIGH_WATERMARK,
+		outbound_low_watermark=OUTBOUND_LOW_WATERMARK, session_timeout=SESSION_TIMEOUT,
+		route_cache=None):
+		super().setup(routes, registry, debug=debug, compression_level=compression_level,
+			compression_threshold=compression_threshold,
+			outbound_high_watermark=outbound_high_watermark,
+			outbound_low_watermark=outbound_low_watermark,
+			outbound_policies=OUTBOUND_POLICIES, session_timeout=session_timeout,
+			route_cache=route_cache)
 		self.broadcast = broadcast
 		self.channel = None
 		self.name = "Unknown"
@@ -179,16 +342,52 @@ class Handler(Server):
 	def ready(self):
 		if self.debug:
 			Logging.info("Handler for '%s:%d' ready." % (self.address, self.port))
+		if self.session_state != None:
+			self.resume(self.session_state)
+			self.session_state = None
+
+
+	def suspend(self):
+		return {"channel" : self.channel, "name" : self.name,
+			"peers" : self.routes["peers"].get_state(self)}
+
+
+	def resume(self, state):
+		self.name = state["name"]
+		if state["channel"] != None:
+			self.registry.set_channel(self, state["channel"])
+			self.broadcast.add(self, self.channel)
+		self.routes["peers"].restore(self, state["peers"])
+		self.routes["peers"].push_changes(self)
 		
 
 	def closed(self, code, reason):
+		super().closed(code, reason)
+		# Controllers stop sending sensor readouts to it right away unless it
+		# might resume its session
+		if not self.keeps_session(code):
+			for peer in self.registry.in_channel(Subscribe.WALLABY):
+				peer.send({"unavaliable" : [self.id_]}, META_ROUTE)
 		if self.channel != None:
 			self.broadcast.remove(self, self.channel)
 		if self.debug:
 			Logging.info("'%s:%d' disconnected." % (self.address, self.port))
+		self.routes["peers"].unsubscribe_all(self)
 		self.routes["peers"].push_changes(self)
 
 
+# Upgrade handshakes are handled on their own threads so a connection storm
+# doesn't serialize behind slow clients. Established websockets are still
+# handed off to the websocket manager.
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+	daemon_threads = True
+	# Default of 5 drops connections when a whole room connects at once
+	request_queue_size = 128
+
+
+SERVER_MODES = {"serial" : WSGIServer, "threaded" : ThreadingWSGIServer}
+
+
 def folder_validator(folder):
 	if not os.path.isdir(folder):
 		try:
@@ -203,8 +402,42 @@ CONFIG_PATH = "server.cfg"
 config = Config.Config()
 config.add(Config.Option("server_address", ("127.0.0.1", 3077)))
 config.add(Config.Option("debug", True, validator=lambda x: True if True or False else False))
+config.add(Config.Option("log_level", "info", validator=lambda x: x in Logging.LEVELS))
+config.add(Config.Option("log_file", None, validator=lambda x: x == None or type(x) is str))
+config.add(Config.Option("log_file_max_bytes", 2**20,
+	validator=lambda x: type(x) is int and x >= 0))
+config.add(Config.Option("log_file_backups", 3, validator=lambda x: type(x) is int and x >= 0))
 config.add(Config.Option("binary_path", "Binaries", validator=folder_validator))
 config.add(Config.Option("source_path", "Source", validator=folder_validator))
+config.add(Config.Option("server_mode", "threaded", validator=lambda x: x in SERVER_MODES))
+config.add(Config.Option("peer_update_window", 0.1,
+	validator=lambda x: type(x) in (int, float) and x >= 0))
+config.add(Config.Option("compile_workers", os.cpu_count() or 1,
+	validator=lambda x: type(x) is int and x > 0))
+config.add(Config.Option("compile_cache_size", 256,
+	validator=lambda x: type(x) is int and x > 0))
+config.add(Config.Option("source_poll_interval", 1.0,
+	validator=lambda x: type(x) in (int, float) and x >= 0))
+config.add(Config.Option("auto_rebuild", True, validator=lambda x: type(x) is bool))
+config.add(Config.Option("stats_interval", 0,
+	validator=lambda x: type(x) in (int, float) and x >= 0))
+config.add(Config.Option("compression_level", COMPRESSION_LEVEL,
+	validator=lambda x: type(x) is int and 0 <= x <= 9))
+config.add(Config.Option("compression_threshold", COMPRESSION_THRESHOLD,
+	validator=lambda x: type(x) is int and x >= 0))
+config.add(Config.Option("outbound_high_watermark", OUTBOUND_HIGH_WATERMARK,
+	validator=lambda x: type(x) is int and x >= 0))
+config.add(Config.Option("outbound_low_watermark", OUTBOUND_LOW_WATERMARK,
+	validator=lambda x: type(x) is int and x >= 0))
+config.add(Config.Option("session_timeout", SESSION_TIMEOUT,
+	validator=lambda x: type(x) in (int, float) and x >= 0))
+config.add(Config.Option("heartbeat_interval", HEARTBEAT_INTERVAL,
+	validator=lambda x: type(x) in (int, float) and x >= 0))
+config.add(Config.Option("heartbeat_timeout", HEARTBEAT_TIMEOUT,
+	validator=lambda x: type(x) in (int, float) and x > 0))
+# Exchange maps of known clients, None only keeps them in memory
+config.add(Config.Option("route_cache_path", "route_cache.json",
+	validator=lambda x: x == None or type(x) is str))
 
 try:
 	config = config.read_from_file(CONFIG_PATH)
@@ -213,28 +446,54 @@ except FileNotFoundError:
 	config = config.read_from_file(CONFIG_PATH)
 
 
+Logging.set_level(config.log_level)
+if config.log_file != None:
+	Logging.set_log_file(config.log_file, max_bytes=config.log_file_max_bytes,
+		backups=config.log_file_backups)
+
+if config.stats_interval > 0:
+	Metrics.metrics.start_dump(config.stats_interval)
+
+registry = PeerRegistry()
+if config.heartbeat_interval > 0:
+	registry.start_heartbeat(config.heartbeat_interval, config.heartbeat_timeout)
+
+route_cache = RouteCache(config.route_cache_path)
+
 broadcast = Broadcast()
 # Populating broadcast channels with all channels defined in Subscribe.Channels
 for channel in Subscribe.CHANNELS:
 	broadcast.add_channel(channel)
 
-compile = Compile(config.source_path, config.binary_path)
+index = SourceIndex(config.source_path, poll_interval=config.source_poll_interval)
+compiler = Compiler(index, config.binary_path,
+	workers=config.compile_workers, cache_size=config.compile_cache_size)
+if config.auto_rebuild:
+	index.listeners.append(compiler.rebuild)
+index.start()
 
 
 server = make_server(config.server_address[0], config.server_address[1],
-	server_class=WSGIServer, handler_class=WebSocketWSGIRequestHandler,
+	server_class=SERVER_MODES[config.server_mode], handler_class=WebSocketWSGIRequestHandler,
 	app=None)
 server.initialize_websockets_manager()
 
 server.set_app(WebSocketWSGIApplication(handler_cls=Handler,
 		handler_args={"debug" : config.debug, "broadcast" : broadcast,
-		"websockets" : server.manager.websockets,
+		"registry" : registry, "compression_level" : config.compression_level,
+		"compression_threshold" : config.compression_threshold,
+		"outbound_high_watermark" : config.outbound_high_watermark,
+		"outbound_low_watermark" : config.outbound_low_watermark,
+		"session_timeout" : config.session_timeout, "route_cache" : route_cache,
 		"routes" : {"info" : Info(),
 		"whoami" : WhoAmI(),
+		"compile" : Compile(compiler),
+		"sources" : Sources(index),
+		"stats" : Stats(compiler),
 		"subscribe" : Subscribe(),
 		"hostname" : DummyPipe(),
 		"processes" : DummyPipe(),
-		"peers" : Peers(),
+		"peers" : Peers(update_window=config.peer_update_window),
 		"sensor" : DummyPipe(),
 		"identify" : DummyPipe(),
 		"list_programs" : DummyPipe(),
@@ -246,7 +505,7 @@ server.set_app(WebSocketWSGIApplication(handler_cls=Handler,
 
 
 try:
-	Logging.header("Server loop starting.")
+	Logging.header("Server loop starting. (%s mode)" % config.server_mode)
 	server.serve_forever()
 except KeyboardInterrupt:
 	Logging.header("Gracefully shutting down server.")
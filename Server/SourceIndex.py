@@ -0,0 +1,184 @@
+import Logging
+
+import os
+import re
+import time
+import hashlib
+import threading
+
+
+class Entry:
+	def __init__(self, mtime, size, hash_, has_main, includes):
+		self.mtime = mtime
+		self.size = size
+		self.hash = hash_
+		self.has_main = has_main
+		self.includes = includes
+
+
+# Keeps metadata of all C sources and headers below source_path so compile
+# requests don't have to read and scan files. Changes are picked up by
+# polling mtimes, a stale file is also refreshed when it is looked up.
+class SourceIndex:
+	HAS_MAIN = re.compile(rb"^\w*\s*main\(\)", re.MULTILINE)
+	LOCAL_INCLUDE = re.compile(rb'^\s*#\s*include\s*"([^"]+)"', re.MULTILINE)
+	EXTENSIONS = (".c", ".h")
+
+	def __init__(self, source_path, poll_interval=1.0):
+		self.source_path = os.path.abspath(source_path) + "/"
+		self.poll_interval = poll_interval
+		self.entries = {}
+		# path -> paths that include it
+		self.included_by = {}
+		# Changes not yet reported by scan (lookups refresh files as well)
+		self.changed = set()
+		# Called with the relpaths of all programs affected by a change
+		self.listeners = []
+		self.lock = threading.RLock()
+		self.scan()
+
+
+	def start(self):
+		if self.poll_interval > 0:
+			thread = threading.Thread(target=self._poll)
+			thread.daemon = True
+			thread.start()
+
+
+	def _poll(self):
+		while True:
+			time.sleep(self.poll_interval)
+			changed = self.scan()
+			if changed:
+				programs = self.get_affected_programs(changed)
+				for listener in self.listeners:
+					try:
+						listener(programs)
+					except Exception as e:
+						Logging.error("Source index listener failed: %s" % e)
+
+
+	# Returns the paths that were added, modified or removed since the last scan
+	def scan(self):
+		found = set()
+		for folder, folders, files in os.walk(self.source_path):
+			# Hidden folders (.git, ...) are not part of the source tree
+			folders[:] = [name for name in folders if not name.startswith(".")]
+			for name in files:
+				if name.endswith(SourceIndex.EXTENSIONS):
+					path = os.path.join(folder, name)
+					found.add(path)
+					self.refresh(path)
+		with self.lock:
+			for path in list(self.entries):
+				# Included files with other extensions are indexed on lookup
+				if path not in found and not os.path.isfile(path):
+					self._remove(path)
+			changed = self.changed
+			self.changed = set()
+		return changed
+
+
+	# Re-indexes path if its mtime or size changed, returns whether it did
+	def refresh(self, path):
+		try:
+			stat = os.stat(path)
+		except OSError:
+			with self.lock:
+				if path in self.entries:
+					self._remove(path)
+					return True
+			return False
+		with self.lock:
+			entry = self.entries.get(path)
+			if entry != None and entry.mtime == stat.st_mtime_ns and entry.size == stat.st_size:
+				return False
+		try:
+			source = open(path, "rb").read()
+		except OSError:
+			return False
+		includes = []
+		for include in SourceIndex.LOCAL_INCLUDE.findall(source):
+			include = include.decode(errors="replace")
+			for folder in (os.path.dirname(path), self.source_path):
+				include_path = os.path.abspath(os.path.join(folder, include))
+				if include_path.startswith(self.source_path) and os.path.isfile(include_path):
+					includes.append(include_path)
+					break
+		with self.lock:
+			if path in self.entries:
+				self._unlink(path)
+			self.entries[path] = Entry(stat.st_mtime_ns, stat.st_size,
+				hashlib.sha256(source).hexdigest(),
+				path.endswith(".c") and SourceIndex.HAS_MAIN.search(source) != None,
+				includes)
+			for include_path in includes:
+				self.included_by.setdefault(include_path, set()).add(path)
+			self.changed.add(path)
+		return True
+
+
+	def _unlink(self, path):
+		for include_path in self.entries[path].includes:
+			if include_path in self.included_by:
+				self.included_by[include_path].discard(path)
+				if not self.included_by[include_path]:
+					del self.included_by[include_path]
+
+
+	def _remove(self, path):
+		self._unlink(path)
+		del self.entries[path]
+		self.changed.add(path)
+
+
+	def get(self, path):
+		path = os.path.abspath(path)
+		if not path.startswith(self.source_path):
+			return None
+		self.refresh(path)
+		with self.lock:
+			return self.entries.get(path)
+
+
+	# All headers path includes, directly or through other headers
+	def get_dependencies(self, path):
+		dependencies = set()
+		with self.lock:
+			stack = [path]
+			while stack:
+				entry = self.entries.get(stack.pop())
+				if entry != None:
+					for include_path in entry.includes:
+						if include_path not in dependencies and include_path != path:
+							self.refresh(include_path)
+							dependencies.add(include_path)
+							stack.append(include_path)
+		return dependencies
+
+
+	def get_affected_programs(self, paths):
+		affected = set()
+		with self.lock:
+			stack = list(paths)
+			seen = set(stack)
+			while stack:
+				path = stack.pop()
+				entry = self.entries.get(path)
+				if entry != None and entry.has_main:
+					affected.add(self.get_relpath(path))
+				for including_path in self.included_by.get(path, ()):
+					if including_path not in seen:
+						seen.add(including_path)
+						stack.append(including_path)
+		return sorted(affected)
+
+
+	def get_programs(self):
+		with self.lock:
+			return sorted(self.get_relpath(path) for path, entry in self.entries.items()
+				if entry.has_main)
+
+
+	def get_relpath(self, path):
+		return path[len(self.source_path):]
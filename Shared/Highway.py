@@ -1,23 +1,36 @@
 import Logging
-import gzip
+import Metrics
+import zlib
 import struct
 import json
 import binascii
 import os
+import time
+import random
+import hashlib
+import socket
 
 from Utils import capture_trace
-from threading import Lock
+from threading import Lock, Condition, Thread, local
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from ws4py.websocket import WebSocket
 from ws4py.client.threadedclient import WebSocketClient
+from ws4py.exc import HandshakeError
 
 INDEXED_DICT = 5
 NoneType = None.__class__
 
+# Only emitted when the binary codec was negotiated
+BINARY_INT = 7
+BINARY_FLOAT = 8
+BINARY_DATA_TYPES = (BINARY_INT, BINARY_FLOAT)
+
 DATA_TYPES = {str : 0, dict : 1,
 	list : 1, bytes : 2,
 	int : 3, float : 4, INDEXED_DICT : 5,
-	NoneType : 6}
+	NoneType : 6, BINARY_INT : 7, BINARY_FLOAT : 8}
 
 
 def reverse_dict(dict):
@@ -26,6 +39,16 @@ def reverse_dict(dict):
 
 REVERSE_DATA_TYPES = reverse_dict(DATA_TYPES)
 
+# Set on the data type id of the header right in front of a zlib compressed
+# payload, only sent to peers that negotiated compression
+COMPRESSED = 0x80
+
+# Indexed by data type id (with or without the COMPRESSED flag), used when
+# parsing headers
+DATA_TYPES_BY_ID = tuple(REVERSE_DATA_TYPES[id_] for id_ in range(len(REVERSE_DATA_TYPES)))
+DATA_TYPES_BY_ID = (DATA_TYPES_BY_ID + (None, ) * (COMPRESSED - len(DATA_TYPES_BY_ID)) +
+	DATA_TYPES_BY_ID)
+
 INVALID_ROUTE = 1
 INVALID_METADATA_LAYOUT = 2
 INVALID_DATA_TYPE = 3
@@ -35,25 +58,99 @@ META_ROUTE_INDEX = 0
 
 PIPE_ROUTE = "pipe"
 
+# Carries several complete messages in one frame (see SendBatch), peers that
+# don't have this route never receive batches
+BATCH_ROUTE = "batch"
+BATCH_MAX_BYTES = 2**16
+
+# Outbound queue policies (per route) once the high watermark is reached:
+# the producer waits, the oldest queued messages of the route are dropped
+# or the message is queued anyway
+BLOCK = "block"
+DROP_OLDEST = "drop_oldest"
+NEVER_DROP = "never_drop"
+OUTBOUND_HIGH_WATERMARK = 2**20
+OUTBOUND_LOW_WATERMARK = 2**18
+# Set while a thread handles a received message. ws4py reads every connection
+# of a server on one thread, so sends from there must never block.
+RECEIVING = local()
+
+# Reconnecting clients send their session token in this header, the server
+# keeps the state of a closed connection for SESSION_TIMEOUT seconds
+SESSION_HEADER = "X-Fl0w-Session"
+# Clients with an identity always get the same pipe id (see get_identity_id)
+IDENTITY_HEADER = "X-Fl0w-Identity"
+# Close code of a connection that was replaced by a newer one of the same
+# identity, clients don't reconnect after it
+CLOSE_REPLACED = 4001
+SESSION_TOKEN_LENGTH = 32
+SESSION_TIMEOUT = 30
+# Connections closed on purpose (normal closure, going away) don't keep a session
+CLEAN_CLOSE_CODES = (1000, 1001)
+RECONNECT_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30
+
+# Clients send the hash of their exchange map and (if they have it cached) of
+# the server's one, full maps are only exchanged if a side doesn't know them yet
+ROUTES_HEADER = "X-Fl0w-Routes"
+ROUTES_HASH_LENGTH = 16
+ROUTE_CACHE_SIZE = 64
+
+# The server pings peers that support it every HEARTBEAT_INTERVAL seconds
+# and evicts them if nothing was received for HEARTBEAT_TIMEOUT seconds
+HEARTBEAT_INTERVAL = 5
+HEARTBEAT_TIMEOUT = 15
+
 PACK_FORMAT = "BH"
-METADATA_LENGTH = struct.calcsize(PACK_FORMAT)
+METADATA_STRUCT = struct.Struct(PACK_FORMAT)
+METADATA_LENGTH = METADATA_STRUCT.size
 
 # Percise enough for now
 PIPE_ID_LENGTH = 8
 
 # Perspective: Packaged by client 1 for server
 PIPE_SRC_PACK_FORMAT = "BH%is" % PIPE_ID_LENGTH
-PIPE_SRC_METADATA_LENGTH = struct.calcsize(PIPE_SRC_PACK_FORMAT)
-PIPE_SRC_METADATA_LENGTH = struct.calcsize(PIPE_SRC_PACK_FORMAT)
+PIPE_SRC_METADATA_STRUCT = struct.Struct(PIPE_SRC_PACK_FORMAT)
+PIPE_SRC_METADATA_LENGTH = PIPE_SRC_METADATA_STRUCT.size
 
 # Perspective: Packaged by server for client 2
 PIPE_DEST_PACK_FORMAT = "B%is" % PIPE_ID_LENGTH
-PIPE_DEST_METADATA_LENGTH = struct.calcsize(PIPE_DEST_PACK_FORMAT)
-PIPE_DEST_METADATA_LENGTH = struct.calcsize(PIPE_DEST_PACK_FORMAT)
+PIPE_DEST_METADATA_STRUCT = struct.Struct(PIPE_DEST_PACK_FORMAT)
+PIPE_DEST_METADATA_LENGTH = PIPE_DEST_METADATA_STRUCT.size
+
+# (data type id, route) -> packed header, there are only a few combinations
+METADATA_CACHE = {}
+
+CODEC_JSON = "json"
+CODEC_BINARY = "binary"
+# Ordered by preference, the first codec both peers know is used
+CODECS = (CODEC_BINARY, CODEC_JSON)
+
+COMPRESSION_ZLIB = "zlib"
+COMPRESSIONS = (COMPRESSION_ZLIB, )
+# Payloads below the threshold (bytes) are never compressed, level 0 disables
+# compressing outgoing messages (incoming ones are still understood)
+COMPRESSION_LEVEL = 6
+COMPRESSION_THRESHOLD = 1024
+# Compressed payloads that inflate beyond this (bytes) are rejected
+MAX_DECOMPRESSED_SIZE = 2**24
+
+# Binary codec layout (little endian)
+# Scalars: int64 or float64, everything else is sent like JSON
+INT_STRUCT = struct.Struct("<q")
+FLOAT_STRUCT = struct.Struct("<d")
+LENGTH_STRUCT = struct.Struct("<I")
+INT_MIN = -2**63
+INT_MAX = 2**63 - 1
 
 
 # Routing related
 class Route:
+	# Blocking routes are run on a pool of workers (shared by all handlers
+	# using the route instance) instead of the receive thread
+	blocking = False
+	workers = 1
+
 	def run(self, data, handler):
 		pass
 
@@ -69,6 +166,53 @@ class Pipe(Route):
 		pass
 
 
+# Messages of one handler are run in the order they were received, messages
+# of different handlers run in parallel (up to workers at a time)
+class RoutePool:
+	def __init__(self, workers):
+		self.executor = ThreadPoolExecutor(max_workers=workers)
+		self.queues = {}
+		self.lock = Lock()
+
+
+	def submit(self, handler, call):
+		with self.lock:
+			queue = self.queues.get(handler)
+			if queue != None:
+				queue.append(call)
+				return
+			self.queues[handler] = deque((call, ))
+		self.executor.submit(self._run, handler)
+
+
+	def _run(self, handler):
+		while True:
+			with self.lock:
+				queue = self.queues[handler]
+				if not queue:
+					del self.queues[handler]
+					return
+				call = queue.popleft()
+			try:
+				call()
+			except Exception:
+				Logging.error("Route raised an exception.")
+				capture_trace()
+
+
+ROUTE_POOLS_LOCK = Lock()
+
+
+def get_route_pool(route):
+	try:
+		return route.pool
+	except AttributeError:
+		with ROUTE_POOLS_LOCK:
+			if not hasattr(route, "pool"):
+				route.pool = RoutePool(route.workers)
+		return route.pool
+
+
 def create_routes(routes):
 	routes = routes.copy()
 	for prefix in routes:
@@ -103,7 +247,44 @@ def create_exchange_map(routes):
 	return exchange_map
 
 
+def negotiate_codec(peer_codecs):
+	for codec in CODECS:
+		if codec in peer_codecs:
+			return codec
+	return CODEC_JSON
+
+
+def get_identity_id(identity):
+	return hashlib.sha256(identity.encode()).hexdigest()[:PIPE_ID_LENGTH]
+
+
+def get_header(environ, header):
+	return (environ or {}).get("HTTP_" + header.upper().replace("-", "_"))
+
+
+def negotiate_compression(peer_compressions):
+	for compression in COMPRESSIONS:
+		if compression in peer_compressions:
+			return compression
+	return None
+
+
+def get_exchange_map_hash(exchange_map):
+	table = json.dumps(sorted(exchange_map.items()))
+	return hashlib.sha256(table.encode()).hexdigest()[:ROUTES_HASH_LENGTH]
+
+
+# Exchange ids are consecutive, the list index is the id
+def compact_exchange_map(exchange_map):
+	return [exchange_map[exchange_id] for exchange_id in range(len(exchange_map))]
+
+
 def convert_exchange_map(routes):
+	if type(routes) is list:
+		for route in routes:
+			if type(route) is not str:
+				return None
+		return dict(enumerate(routes))
 	exchange_map = {}
 	for key in routes:
 		if key.isnumeric() and type(routes[key]) is str:
@@ -113,33 +294,89 @@ def convert_exchange_map(routes):
 	return exchange_map
 
 
+# (exchange map, reverse exchange map) of the peer. Full exchange maps are
+# cached (handlers with the same peer routes share them), a hash is only
+# accepted if it is the one that was looked up when the connection was established.
+def receive_exchange_map(data, handler):
+	if "routes" in data:
+		exchange_map = convert_exchange_map(data["routes"])
+		if exchange_map == None:
+			return None
+		if handler.route_cache != None:
+			return handler.route_cache.add(exchange_map)
+		return exchange_map, reverse_dict(exchange_map)
+	if handler.cached_peer_routes != None and handler.cached_peer_routes[0] == data["routes_hash"]:
+		return handler.cached_peer_routes[1:]
+	return None
+
+
 class ConvertFailedError(ValueError):
 	def __init__(self):
 		super(ValueError, self).__init__("conversion failed (invalid data type supplied)")
 
 
+class DecompressionFailedError(ValueError):
+	def __init__(self):
+		super(ValueError, self).__init__("decompression failed (corrupt or truncated "
+			"payload or larger than %d bytes)" % MAX_DECOMPRESSED_SIZE)
+
+
 # Built-in routes
 class Meta(Route):
 	def run(self, data, handler):
 		if type(data) is dict:
-			if "routes" in data:
-				peer_exchange_routes = convert_exchange_map(data["routes"])
+			if "routes" in data or "routes_hash" in data:
+				peer_exchange_routes = receive_exchange_map(data, handler)
 				if peer_exchange_routes != None:
-					handler.peer_exchange_routes = peer_exchange_routes
+					handler.peer_exchange_routes, handler.peer_reverse_exchange_routes = (
+						peer_exchange_routes)
 					if handler.debug:
 						Logging.success("Received peer exchange routes: %s" % str(data))
-					handler.peer_reverse_exchange_routes = reverse_dict(handler.peer_exchange_routes)
 					if issubclass(handler.__class__, Client):
-						handler.send({"routes" : handler.exchange_routes}, META_ROUTE)
+						# Peers that don't offer any codecs only understand JSON
+						codec = negotiate_codec(data.get("codecs", ()))
+						compression = negotiate_compression(data.get("compressions", ()))
+						reply = {"codec" : codec, "compression" : compression, "heartbeat" : True}
+						# Servers that send a hash understand hashes and compact maps
+						if "routes_hash" in data:
+							reply["routes_hash"] = handler.routes_hash
+							if data.get("routes_known") is not True:
+								reply["routes"] = compact_exchange_map(handler.exchange_routes)
+						else:
+							reply["routes"] = handler.exchange_routes
+						handler.send(reply, META_ROUTE)
+						if handler.route_cache != None:
+							handler.route_cache.set_peer(handler.url,
+								get_exchange_map_hash(handler.peer_exchange_routes))
+						handler.codec = codec
+						handler.compression = compression
+						session = data.get("session")
+						if type(session) is dict:
+							handler.session_token = session.get("token")
+							handler.resumed = session.get("resumed") is True
+						heartbeat = data.get("heartbeat")
+						if type(heartbeat) is dict and type(heartbeat.get("timeout")) in (int, float):
+							handler.watch_heartbeat(heartbeat["timeout"])
+					else:
+						if data.get("codec") in CODECS:
+							handler.codec = data["codec"]
+						if data.get("compression") in COMPRESSIONS:
+							handler.compression = data["compression"]
+						handler.heartbeat = data.get("heartbeat") is True
+					if handler.debug:
+						Logging.info("Using '%s' codec (compression: %s)." % (handler.codec,
+							handler.compression))
 					try:
 						handler.ready()
 					except AttributeError:
 						pass
-					if handler.debug:
-						Logging.info("Launching routes.")
-					launch_routes(handler.routes, handler)
-					if handler.debug:
-						Logging.info("Routes launched.")
+					# Routes of a resumed session are still running
+					if not handler.resumed:
+						if handler.debug:
+							Logging.info("Launching routes.")
+						launch_routes(handler.routes, handler)
+						if handler.debug:
+							Logging.info("Routes launched.")
 				else:
 					Logging.error("Received invalid exchange routes.")
 			if "unavaliable" in data:
@@ -148,6 +385,15 @@ class Meta(Route):
 							handler.peer_unavaliable(peer)
 					except AttributeError:
 						Logging.warning("Handler does not implement a 'peer_unavaliabe' method.")
+			# Sent by the server while a peer we pipe to does not keep up
+			if "congested" in data:
+				handler.congested_peers.update(data["congested"])
+			if "uncongested" in data:
+				handler.congested_peers.difference_update(data["uncongested"])
+			if "ping" in data:
+				handler.send({"pong" : data["ping"]}, META_ROUTE)
+			if "pong" in data and type(data["pong"]) is float:
+				handler.rtt = time.monotonic() - data["pong"]
 		if type(data) is int:
 			if data == 1:
 				Logging.error("Last route was invalid.")
@@ -169,101 +415,385 @@ class ServerPipe(Route):
 	def run(self, data, handler):
 		data_type, m_route, id_ = parse_pipe_src_metadata(data)
 		id_ = id_.decode()
-		data = convert_data(data[PIPE_SRC_METADATA_LENGTH:], data_type)
 		route = handler.exchange_routes[m_route]
-		if id_ in handler.peers:
+		peer = handler.peers.get(id_)
+		if peer != None:
 			if handler.debug:
-				Logging.info("Forwarding to '%s' on route '%s'" % (id_, route),
+				Logging.debug("Forwarding to '%s' on route '%s'", id_, route,
 					color=Logging.LIGHT_YELLOW)
-			handler.peers[id_].send(pack_pipe_dest_message(data, handler.id_), route)
+			if ((data_type in BINARY_DATA_TYPES and peer.codec != CODEC_BINARY) or
+				(data[0] & COMPRESSED and peer.compression == None)):
+				self.transcode(data, data_type, route, peer, handler)
+			else:
+				self.forward(data, route, peer, handler)
+			if peer.outbound != None and peer.outbound.congested:
+				peer.outbound.add_source(handler)
 		else:
+			# The peer might still resume its session
+			if handler.registry.is_detached(id_):
+				return
 			handler.send({"unavaliable" : [id_]}, "meta")
 			if handler.debug:
 				Logging.error("'%s' is not present in peers." % id_)
 
 
+	# The payload is never looked at, only the pipe header is rewritten
+	def forward(self, data, route, peer, handler):
+		try:
+			exchange_route = peer.peer_reverse_exchange_routes[route]
+		except KeyError:
+			Logging.error("'%s' is not a valid peer route." % route)
+		else:
+			peer.send_packed(pack_forwarded_pipe_message(data, exchange_route,
+				handler.id_), route)
+
+
+	# Peer does not understand the payload encoding (e.g. old JSON-only peer)
+	def transcode(self, data, data_type, route, peer, handler):
+		try:
+			data = convert_data(get_payload(data, PIPE_SRC_METADATA_LENGTH), data_type)
+		except DecompressionFailedError as e:
+			Logging.error("Dropped message from '%s' to '%s': %s" % (handler.id_, peer.id_, e))
+			return
+		peer.send(pack_pipe_dest_message(data, handler.id_, codec=peer.codec,
+			compression=peer.get_compression()), route)
+
+
 class DummyPipe(Route):
 	def run(self, data, handler):
 		pass
 
 
+# Payload is a sequence of length-prefixed messages, they are handled in order
+# as if they had been received one by one
+class Batch(Route):
+	def run(self, data, handler):
+		data = memoryview(data)
+		offset = 0
+		while offset < len(data):
+			length = LENGTH_STRUCT.unpack_from(data, offset)[0]
+			offset += LENGTH_STRUCT.size
+			handler.handle_message(data[offset:offset + length])
+			offset += length
+
+
+# Packed messages are collected by a sender thread and sent as one batch once
+# window seconds have passed since the first one or max_bytes are pending.
+# Messages to a peer are sent from its own thread. Once high_watermark bytes
+# are queued the peer is congested and messages are handled according to the
+# policy of their route (BLOCK by default). Peers that pipe to a congested peer
+# are told so ("congested" on the meta route) until the queue is back below
+# low_watermark.
+class OutboundQueue:
+	__slots__ = ("handler", "high_watermark", "low_watermark", "policies", "messages",
+		"droppable", "size", "dropped", "congested", "sources", "running", "condition")
+
+	def __init__(self, handler, high_watermark=OUTBOUND_HIGH_WATERMARK,
+		low_watermark=OUTBOUND_LOW_WATERMARK, policies={}):
+		self.handler = handler
+		self.high_watermark = high_watermark
+		self.low_watermark = low_watermark
+		self.policies = policies
+		# [message, route] entries, dropped entries are set to None
+		self.messages = deque()
+		# Queued entries of DROP_OLDEST routes
+		self.droppable = {}
+		self.size = 0
+		self.dropped = 0
+		self.congested = False
+		self.sources = {}
+		self.running = True
+		self.condition = Condition()
+		thread = Thread(target=self._send)
+		thread.daemon = True
+		thread.start()
+
+
+	def put(self, message, route):
+		policy = self.policies.get(route, BLOCK)
+		# Relayed messages are queued, their sources are told to back off instead
+		if policy == BLOCK and getattr(RECEIVING, "active", False):
+			policy = NEVER_DROP
+		with self.condition:
+			if policy == BLOCK:
+				while self.size >= self.high_watermark and self.running:
+					self.condition.wait()
+			elif policy == DROP_OLDEST:
+				entries = self.droppable.setdefault(route, deque())
+				while self.size >= self.high_watermark and entries:
+					entry = entries.popleft()
+					self.size -= len(entry[0])
+					entry[0] = None
+					self.dropped += 1
+			if not self.running:
+				return
+			entry = [message, route]
+			self.messages.append(entry)
+			if policy == DROP_OLDEST:
+				self.droppable[route].append(entry)
+			self.size += len(message)
+			if self.size >= self.high_watermark:
+				self.congested = True
+			self.condition.notify_all()
+
+
+	def add_source(self, handler):
+		with self.condition:
+			if not self.congested or handler.id_ in self.sources:
+				return
+			self.sources[handler.id_] = handler
+		handler.send({"congested" : [self.handler.id_]}, META_ROUTE)
+
+
+	def stop(self):
+		with self.condition:
+			self.running = False
+			self.condition.notify_all()
+
+
+	def get(self):
+		with self.condition:
+			return {"pending" : self.size, "dropped" : self.dropped,
+				"congested" : self.congested}
+
+
+	def _send(self):
+		while True:
+			with self.condition:
+				while not self.messages and self.running:
+					self.condition.wait()
+				if not self.running:
+					return
+				entries = self.messages
+				self.messages = deque()
+				self.droppable = {}
+			for entry in entries:
+				message = entry[0]
+				if message == None:
+					continue
+				try:
+					self.handler.raw_send(message, binary=True)
+				except (OSError, RuntimeError):
+					self.stop()
+					return
+				sources = None
+				with self.condition:
+					self.size -= len(message)
+					if self.congested and self.size <= self.low_watermark:
+						self.congested = False
+						sources = self.sources
+						self.sources = {}
+					if self.size < self.high_watermark:
+						self.condition.notify_all()
+				if sources:
+					for source in sources.values():
+						source.send({"uncongested" : [self.handler.id_]}, META_ROUTE)
+
+
+class SendBatch:
+	def __init__(self, handler, window, max_bytes=BATCH_MAX_BYTES):
+		self.handler = handler
+		self.window = window
+		self.max_bytes = max_bytes
+		self.messages = []
+		self.size = 0
+		self.started = 0
+		self.running = True
+		self.condition = Condition()
+		thread = Thread(target=self._send)
+		thread.daemon = True
+		thread.start()
+
+
+	def put(self, message):
+		with self.condition:
+			if not self.messages:
+				self.started = time.perf_counter()
+				self.condition.notify()
+			self.messages.append(message)
+			self.size += len(message)
+			if self.size >= self.max_bytes:
+				self.condition.notify()
+
+
+	def stop(self):
+		with self.condition:
+			self.running = False
+			self.condition.notify()
+
+
+	def _send(self):
+		while True:
+			with self.condition:
+				while not self.messages and self.running:
+					self.condition.wait()
+				if not self.messages:
+					return
+				while self.size < self.max_bytes and self.running:
+					remaining = self.started + self.window - time.perf_counter()
+					if remaining <= 0:
+						break
+					self.condition.wait(remaining)
+				messages = self.messages
+				self.messages = []
+				self.size = 0
+			try:
+				self.handler.send_batch(messages)
+			except KeyError:
+				# Packed with the route ids of a connection that is gone
+				Logging.warning("Dropped %d batched messages of a previous connection.",
+					len(messages))
+			except Exception as e:
+				Logging.error("Sending batch failed: %s", e)
+
+
 # Message packing and unpacking
-def create_metadata(data_type, converted_route, indexed_dict=False):
-	return struct.pack(PACK_FORMAT,
-		DATA_TYPES[data_type] if not indexed_dict else DATA_TYPES[INDEXED_DICT],
+def get_data_type_id(data_type, indexed_dict=False):
+	if indexed_dict:
+		return DATA_TYPES[INDEXED_DICT]
+	return DATA_TYPES[data_type]
+
+
+def create_metadata(data_type, converted_route, indexed_dict=False, compressed=False):
+	key = (get_data_type_id(data_type, indexed_dict=indexed_dict) | (COMPRESSED if compressed else 0),
 		converted_route)
+	try:
+		return METADATA_CACHE[key]
+	except KeyError:
+		metadata = METADATA_CACHE[key] = METADATA_STRUCT.pack(*key)
+		return metadata
 
 
 # Perspective: Packaged by client 1 for server
-def create_pipe_src_metadata(data_type, converted_route, id_, indexed_dict=False):
-	return struct.pack(PIPE_SRC_PACK_FORMAT,
-		DATA_TYPES[data_type] if not indexed_dict else DATA_TYPES[INDEXED_DICT],
+def create_pipe_src_metadata(data_type, converted_route, id_, indexed_dict=False,
+	compressed=False):
+	return PIPE_SRC_METADATA_STRUCT.pack(
+		get_data_type_id(data_type, indexed_dict=indexed_dict) | (COMPRESSED if compressed else 0),
 		converted_route, id_.encode())
 
 # Perspective: Packaged by server for client 2
-def create_pipe_dest_metadata(data_type, id_, indexed_dict=False):
-	return struct.pack(PIPE_DEST_PACK_FORMAT,
-		DATA_TYPES[data_type] if not indexed_dict else DATA_TYPES[INDEXED_DICT],
+def create_pipe_dest_metadata(data_type, id_, indexed_dict=False, compressed=False):
+	return PIPE_DEST_METADATA_STRUCT.pack(
+		get_data_type_id(data_type, indexed_dict=indexed_dict) | (COMPRESSED if compressed else 0),
 		id_.encode())
 
 
+# compression is (level, threshold) or None, the compressed payload is only
+# used if it actually is smaller
+def compress_data(data, compression):
+	if compression != None and compression[0] > 0 and len(data) >= compression[1]:
+		compressed_data = zlib.compress(data, compression[0])
+		if len(compressed_data) < len(data):
+			return compressed_data, True
+	return data, False
+
+
+# Payload following a header, decompressed if the header is flagged
+def get_payload(message, metadata_length):
+	if message[0] & COMPRESSED:
+		decompressor = zlib.decompressobj()
+		try:
+			payload = decompressor.decompress(memoryview(message)[metadata_length:],
+				MAX_DECOMPRESSED_SIZE)
+		except zlib.error:
+			raise DecompressionFailedError()
+		# Larger than allowed or truncated
+		if decompressor.unconsumed_tail or not decompressor.eof:
+			raise DecompressionFailedError()
+		return payload
+	return memoryview(message)[metadata_length:]
+
+
 def pack_message(data, exchange_route,
-	debug=False, indexed_dict=False):
-	data, original_data_type = prepare_data(data)
+	debug=False, indexed_dict=False, codec=CODEC_JSON, compression=None):
+	data, original_data_type = prepare_data(data, codec=codec)
+	data, compressed = compress_data(data, compression)
 	return create_metadata(original_data_type, exchange_route,
-		indexed_dict=indexed_dict) + data
+		indexed_dict=indexed_dict, compressed=compressed) + data
 
 
 def pack_pipe_src_message(data, exchange_route, id_, debug=False,
-	indexed_dict=False):
-	data, original_data_type = prepare_data(data)
+	indexed_dict=False, codec=CODEC_JSON, compression=None):
+	data, original_data_type = prepare_data(data, codec=codec)
+	data, compressed = compress_data(data, compression)
 	return create_pipe_src_metadata(original_data_type, exchange_route, id_,
-		indexed_dict=indexed_dict) + data
+		indexed_dict=indexed_dict, compressed=compressed) + data
+
+# Complete frame for the pipe route (header, pipe header, payload), the
+# payload is copied once instead of once per header. Only the piped payload
+# is compressed so the server can forward it without touching it.
+def pack_piped_message(data, pipe_route, exchange_route, id_,
+	indexed_dict=False, codec=CODEC_JSON, compression=None):
+	data, original_data_type = prepare_data(data, codec=codec)
+	data, compressed = compress_data(data, compression)
+	return b"".join((create_metadata(bytes, pipe_route),
+		create_pipe_src_metadata(original_data_type, exchange_route, id_,
+		indexed_dict=indexed_dict, compressed=compressed), data))
+
 
 def pack_pipe_dest_message(data, id_, debug=False,
-	indexed_dict=False):
-	data, original_data_type = prepare_data(data)
+	indexed_dict=False, codec=CODEC_JSON, compression=None):
+	data, original_data_type = prepare_data(data, codec=codec)
+	data, compressed = compress_data(data, compression)
 	return create_pipe_dest_metadata(original_data_type, id_,
-		indexed_dict=indexed_dict) + data
+		indexed_dict=indexed_dict, compressed=compressed) + data
+
+
+# Rewrites a PIPE_SRC message into a PIPE_DEST message wrapped in a regular
+# message without decoding or re-encoding the payload. The payload is sliced
+# through a memoryview so it is only copied once (into the outgoing frame).
+def pack_forwarded_pipe_message(message, exchange_route, id_):
+	return b"".join((create_metadata(bytes, exchange_route),
+		PIPE_DEST_METADATA_STRUCT.pack(message[0], id_.encode()),
+		memoryview(message)[PIPE_SRC_METADATA_LENGTH:]))
 
 
+# Headers are unpacked in place, message can be bytes or a memoryview
 def parse_metadata(message):
-	metadata = struct.unpack(PACK_FORMAT, message[:METADATA_LENGTH])
-	return REVERSE_DATA_TYPES[metadata[0]], metadata[1]
+	metadata = METADATA_STRUCT.unpack_from(message)
+	return DATA_TYPES_BY_ID[metadata[0]], metadata[1]
 
 
 def parse_pipe_src_metadata(message):
-	metadata = struct.unpack(PIPE_SRC_PACK_FORMAT, message[:PIPE_SRC_METADATA_LENGTH])
-	return REVERSE_DATA_TYPES[metadata[0]], metadata[1], metadata[2]
+	metadata = PIPE_SRC_METADATA_STRUCT.unpack_from(message)
+	return DATA_TYPES_BY_ID[metadata[0]], metadata[1], metadata[2]
 
 
 def parse_pipe_dest_metadata(message):
-	metadata = struct.unpack(PIPE_DEST_PACK_FORMAT, message[:PIPE_DEST_METADATA_LENGTH])
-	return REVERSE_DATA_TYPES[metadata[0]], metadata[1]
+	metadata = PIPE_DEST_METADATA_STRUCT.unpack_from(message)
+	return DATA_TYPES_BY_ID[metadata[0]], metadata[1]
 
 def convert_data(data, data_type, debug=False):
 	try:
+		# data may be a memoryview into the received frame, it is decoded
+		# without copying it into bytes first
 		if data_type == str:
 			try:
-				data = data.decode()
+				data = str(data, "utf-8")
 			except UnicodeDecodeError:
 				Logging.warning("Unicode characters are not properly encoded. "
 					"Falling back to unicode_escape.")
-				data = data.decode("unicode_escape")
+				data = bytes(data).decode("unicode_escape")
+		elif data_type == bytes:
+			data = bytes(data)
 		elif data_type == int:
-			data = int(data.decode())
+			data = int(bytes(data))
 		elif data_type == float:
-			data = float(data.decode())
+			data = float(bytes(data))
 		elif data_type in (dict, list):
-			data = json.loads(data.decode())
+			data = json.loads(str(data, "utf-8"))
 		elif data_type == INDEXED_DICT:
-			data = json.loads(data.decode())
+			data = json.loads(str(data, "utf-8"))
 			indexed_data = {}
 			for key in data:
 				indexed_data[int(key)] = data[key]
 			data = indexed_data
 		elif data_type == NoneType:
 			data = None
+		elif data_type == BINARY_INT:
+			data = INT_STRUCT.unpack(data)[0]
+		elif data_type == BINARY_FLOAT:
+			data = FLOAT_STRUCT.unpack(data)[0]
 	except Exception:
 		Logging.error("Data conversion failed.")
 		capture_trace()
@@ -271,10 +801,21 @@ def convert_data(data, data_type, debug=False):
 	return data
 
 
-def prepare_data(data):
+def prepare_data(data, codec=CODEC_JSON):
 	original_data_type = type(data)
 	if original_data_type is str:
 		data = data.encode()
+	elif codec == CODEC_BINARY and original_data_type is not bytes:
+		if original_data_type is int and INT_MIN <= data <= INT_MAX:
+			data = INT_STRUCT.pack(data)
+			original_data_type = BINARY_INT
+		elif original_data_type is float:
+			data = FLOAT_STRUCT.pack(data)
+			original_data_type = BINARY_FLOAT
+		else:
+			# json is implemented in C, a Python container encoding is slower
+			# and not even smaller
+			return prepare_data(data)
 	elif original_data_type in (int, float):
 		data = str(data).encode()
 	elif original_data_type is dict or original_data_type is list:
@@ -284,20 +825,80 @@ def prepare_data(data):
 	return data, original_data_type
 
 
-class Shared:
-	def setup(self, routes, debug=False):
-		self.routes = routes
-		self.routes[META_ROUTE] = Meta()
-		self.routes = create_routes(self.routes)
+# Everything derived from a routes dict. Routes keep per connection state
+# keyed by handler, so the handlers of a server share one table.
+class RouteTable:
+	__slots__ = ("routes", "reverse_routes", "exchange_routes", "reverse_exchange_routes",
+		"routes_hash")
+
+	def __init__(self, routes):
+		routes[META_ROUTE] = Meta()
+		routes[BATCH_ROUTE] = Batch()
+		self.routes = create_routes(routes)
 		self.reverse_routes = reverse_dict(self.routes)
 		self.exchange_routes = create_exchange_map(self.routes)
 		self.reverse_exchange_routes = reverse_dict(self.exchange_routes)
+		self.routes_hash = get_exchange_map_hash(self.exchange_routes)
+
+
+class Shared:
+	# Per connection state, subclasses add their own
+	__slots__ = ("routes", "reverse_routes", "exchange_routes", "reverse_exchange_routes",
+		"routes_hash", "route_cache", "peer_exchange_routes", "peer_reverse_exchange_routes",
+		"cached_peer_routes", "codec", "compression", "congested_peers", "resumed",
+		"heartbeat", "rtt", "last_seen", "compression_level", "compression_threshold",
+		"batch", "outbound", "debug", "metrics", "address", "port")
+
+	# routes is a dict of routes or a RouteTable
+	def setup(self, routes, debug=False, compression_level=COMPRESSION_LEVEL,
+		compression_threshold=COMPRESSION_THRESHOLD, route_cache=None):
+		if type(routes) is not RouteTable:
+			routes = RouteTable(routes)
+		self.routes = routes.routes
+		self.reverse_routes = routes.reverse_routes
+		self.exchange_routes = routes.exchange_routes
+		self.reverse_exchange_routes = routes.reverse_exchange_routes
+		self.routes_hash = routes.routes_hash
+		self.route_cache = route_cache
+		self.reset_peer()
+		self.compression_level = compression_level
+		self.compression_threshold = compression_threshold
+		# Opt-in, see Client.setup
+		self.batch = None
+		# Server only, see Server.setup
+		self.outbound = None
+		self.debug = debug
+		self.metrics = Metrics.metrics
+
+
+	# Everything that is negotiated with the peer during the meta handshake
+	def reset_peer(self):
 		# Peer routes have not been received yet. As per convention the meta route
 		# has to exist and we need it for our first send to succeed (otherwise it
 		# would fail during route lookup).
 		self.peer_exchange_routes = {META_ROUTE_INDEX : META_ROUTE}
 		self.peer_reverse_exchange_routes = reverse_dict(self.peer_exchange_routes)
-		self.debug = debug
+		# (hash, exchange map, reverse exchange map) of the peer if it was found
+		# in the route cache
+		self.cached_peer_routes = None
+		# Switched during the meta handshake if both sides support something better
+		self.codec = CODEC_JSON
+		self.compression = None
+		# Peers the server reported as congested
+		self.congested_peers = set()
+		# Set by clients whose session was restored by the server
+		self.resumed = False
+		# Peer answers pings (server) and round trip time of the last one
+		self.heartbeat = False
+		self.rtt = None
+		self.last_seen = time.monotonic()
+
+
+	# (level, threshold) if the peer negotiated compression
+	def get_compression(self):
+		if self.compression != None:
+			return (self.compression_level, self.compression_threshold)
+		return None
 
 
 	def override_methods(self):
@@ -316,7 +917,16 @@ class Shared:
 
 
 	def patched_received_message(self, message):
-		message = message.data
+		self.last_seen = time.monotonic()
+		RECEIVING.active = True
+		try:
+			self.handle_message(message.data)
+		finally:
+			RECEIVING.active = False
+
+
+	# message can be bytes or a memoryview (messages inside a batch)
+	def handle_message(self, message):
 		data_type, m_route = parse_metadata(message)
 		try:
 			route = self.exchange_routes[m_route]
@@ -325,94 +935,627 @@ class Shared:
 			Logging.error("Received message with non-existing route '%d' from '%s:%d'" % (
 				m_route, self.address, self.port))
 			return
-		data = convert_data(message[METADATA_LENGTH:], data_type)
-		if self.debug:
-			data_repr = str(data).replace("\n", " ")
+		route_ = self.routes.get(route)
+		start = time.perf_counter()
+		try:
+			payload = get_payload(message, METADATA_LENGTH)
+		except DecompressionFailedError as e:
+			self.reject_payload(e)
+			return
+		# Piped payloads are handed on as views, their own header is parsed
+		# (or forwarded) without copying the frame
+		if data_type is bytes and issubclass(route_.__class__, (Pipe, ServerPipe, Batch)):
+			data = payload
+		else:
+			data = convert_data(payload, data_type)
+		decode_time = time.perf_counter() - start
+		if self.debug and Logging.is_enabled(Logging.DEBUG):
+			data_repr = str(data if type(data) is not memoryview else bytes(data)).replace("\n", " ")
 			if len(data_repr) > 80:
 				data_repr = data_repr[:80] + "..."
-			Logging.info("Received '%s' on route '%s': %s (%s:%d)" % (
+			Logging.debug("Received '%s' on route '%s': %s (%s:%d)",
 				type(data).__name__ if not data_type == INDEXED_DICT else "indexed_dict",
 				route, data_repr, self.address,
-				self.port))
-		try:
-			route = self.routes[route]
-		except:
+				self.port)
+		if route_ == None:
 			Logging.warning("'%s' does not exist." % route)
+			if self.metrics.enabled:
+				self.metrics.record(Metrics.IN, route, len(message), decode_time)
 		else:
-			if not issubclass(route.__class__, Pipe):
-				route.run(data, self)
+			if not issubclass(route_.__class__, Pipe):
+				args = (data, self)
 			else:
+				start = time.perf_counter()
 				data_type, peer = parse_pipe_dest_metadata(data)
-				peer = peer.decode()
-				data = convert_data(data[PIPE_DEST_METADATA_LENGTH:], data_type, debug=self.debug)
-				route.run(data, peer, self)
+				try:
+					data = convert_data(get_payload(data, PIPE_DEST_METADATA_LENGTH), data_type,
+						debug=self.debug)
+				except DecompressionFailedError as e:
+					self.reject_payload(e)
+					return
+				decode_time += time.perf_counter() - start
+				args = (data, peer.decode(), self)
+			if route_.blocking:
+				get_route_pool(route_).submit(self, lambda: self.run_route(route_, args, route,
+					len(message), decode_time))
+			else:
+				self.run_route(route_, args, route, len(message), decode_time)
+
+
+	def reject_payload(self, error):
+		self.send(INVALID_DATA_TYPE, META_ROUTE)
+		Logging.error("Rejected message from '%s:%d': %s" % (self.address, self.port, error))
+
+
+	def run_route(self, route_, args, route, length, decode_time):
+		start = time.perf_counter()
+		route_.run(*args)
+		if self.metrics.enabled:
+			self.metrics.record(Metrics.IN, route, length, decode_time,
+				time.perf_counter() - start)
+
+
+	# Sends an already packed message (see pack_forwarded_pipe_message)
+	def send_packed(self, message, route, encode_time=None):
+		self.write(message, route)
+		if self.metrics.enabled:
+			self.metrics.record(Metrics.OUT, route, len(message), encode_time)
+		if self.debug:
+			Logging.debug("Sent %d packed bytes on route '%s' (%s:%d)",
+				len(message), route, self.address, self.port)
+
+
+	# Messages are only batched once the peer's routes are known
+	def write(self, message, route):
+		if self.outbound != None:
+			self.outbound.put(message, route)
+		elif self.batch != None and BATCH_ROUTE in self.peer_reverse_exchange_routes:
+			self.batch.put(message)
+		else:
+			self.raw_send(message, binary=True)
+
+
+	def send_batch(self, messages):
+		if len(messages) == 1:
+			self.raw_send(messages[0], binary=True)
+			return
+		start = time.perf_counter()
+		parts = []
+		for message in messages:
+			parts.append(LENGTH_STRUCT.pack(len(message)))
+			parts.append(message)
+		data, compressed = compress_data(b"".join(parts), self.get_compression())
+		message = create_metadata(bytes, self.peer_reverse_exchange_routes[BATCH_ROUTE],
+			compressed=compressed) + data
+		encode_time = time.perf_counter() - start
+		self.raw_send(message, binary=True)
+		if self.metrics.enabled:
+			self.metrics.record(Metrics.OUT, BATCH_ROUTE, len(message), encode_time)
 
 
 	def patched_send(self, data, route, indexed_dict=False):
+		start = time.perf_counter()
 		try:
-			self.raw_send(pack_message(data,
+			message = pack_message(data,
 				self.peer_reverse_exchange_routes[route],
-				debug=self.debug, indexed_dict=indexed_dict),
-			binary=True)
+				debug=self.debug, indexed_dict=indexed_dict, codec=self.codec,
+				compression=self.get_compression())
 		except KeyError:
 			Logging.error("'%s' is not a valid peer route." % route)
 		else:
-			if self.debug:
+			encoded = time.perf_counter()
+			self.write(message, route)
+			if self.metrics.enabled:
+				self.metrics.record(Metrics.OUT, route, len(message), encoded - start)
+			if self.debug and Logging.is_enabled(Logging.DEBUG):
 				data_repr = str(data).replace("\n", " ")
 				if len(data_repr) > 80:
 					data_repr = data_repr[:80] + "..."
-				Logging.info("Sent '%s' on route '%s': %s (%s:%d)" % (
+				Logging.debug("Sent '%s' on route '%s': %s (%s:%d)",
 					type(data).__name__, route, data_repr, self.address,
-					self.port))
+					self.port)
+
+
+
+# Exchange maps of peers by hash, optionally persisted to a JSON file
+class RouteCache:
+	def __init__(self, path=None, size=ROUTE_CACHE_SIZE):
+		self.path = path
+		self.size = size
+		# (exchange map, reverse exchange map) by hash and the hash of the last
+		# map of every server
+		self.tables = {}
+		self.peers = {}
+		self.lock = Lock()
+		if path != None:
+			self.load()
+
+
+	def get(self, hash_):
+		with self.lock:
+			return self.tables.get(hash_)
+
+
+	def add(self, exchange_map):
+		hash_ = get_exchange_map_hash(exchange_map)
+		with self.lock:
+			if hash_ not in self.tables:
+				self.tables[hash_] = (exchange_map, reverse_dict(exchange_map))
+				while len(self.tables) > self.size:
+					del self.tables[next(iter(self.tables))]
+				self.save()
+			return self.tables[hash_]
+
+
+	def get_peer(self, address):
+		with self.lock:
+			return self.peers.get(address)
+
+
+	def set_peer(self, address, hash_):
+		with self.lock:
+			if self.peers.get(address) != hash_:
+				self.peers[address] = hash_
+				self.save()
+
+
+	def load(self):
+		try:
+			with open(self.path) as file:
+				data = json.load(file)
+		except (OSError, ValueError):
+			return
+		if type(data) is not dict:
+			return
+		for hash_, routes in data.get("tables", {}).items():
+			exchange_map = convert_exchange_map(routes)
+			if exchange_map != None and get_exchange_map_hash(exchange_map) == hash_:
+				self.tables[hash_] = (exchange_map, reverse_dict(exchange_map))
+		for address, hash_ in data.get("peers", {}).items():
+			if hash_ in self.tables:
+				self.peers[address] = hash_
+
+
+	def save(self):
+		if self.path == None:
+			return
+		data = {"tables" : {hash_ : {str(exchange_id) : route
+			for exchange_id, route in exchange_maps[0].items()}
+			for hash_, exchange_maps in self.tables.items()}, "peers" : self.peers}
+		try:
+			with open(self.path + ".tmp", "w") as file:
+				json.dump(data, file)
+			os.replace(self.path + ".tmp", self.path)
+		except OSError as e:
+			Logging.warning("Unable to save route cache: %s" % e)
+
+
+# One registry is shared by all handlers of a server. It is updated when a
+# handler opens, closes or changes its channel, so looking up a peer by pipe
+# id or by channel never has to go through all connections.
+class PeerRegistry:
+	def __init__(self):
+		self.lock = Lock()
+		self.peers = {}
+		self.channels = {}
+		# token -> (id, state, expiry) of closed connections that can be resumed
+		self.sessions = {}
+		self.detached = {}
+		self.heartbeat_interval = 0
+		self.heartbeat_timeout = 0
+		# id(routes) -> (routes, RouteTable)
+		self.route_tables = {}
+
+
+	# Handlers with the same routes dict share one table, unless it has routes
+	# that are created for every handler (see create_routes)
+	def get_route_table(self, routes):
+		shared = not any(type(route) in (tuple, list) for route in routes.values())
+		with self.lock:
+			if shared and id(routes) in self.route_tables:
+				return self.route_tables[id(routes)][1]
+			route_table = RouteTable(dict(routes, **{PIPE_ROUTE : ServerPipe()}))
+			if shared:
+				self.route_tables[id(routes)] = (routes, route_table)
+			return route_table
+
+
+	def add(self, handler):
+		with self.lock:
+			self.peers[handler.id_] = handler
+			channel = getattr(handler, "channel", None)
+			if channel != None:
+				self.channels.setdefault(channel, {})[handler.id_] = handler
+
+
+	def remove(self, handler):
+		with self.lock:
+			if self.peers.get(handler.id_) is handler:
+				del self.peers[handler.id_]
+			self._remove_from_channel(handler)
+
+
+	def set_channel(self, handler, channel):
+		with self.lock:
+			self._remove_from_channel(handler)
+			handler.channel = channel
+			if self.peers.get(handler.id_) is handler and channel != None:
+				self.channels.setdefault(channel, {})[handler.id_] = handler
+
+
+	def _remove_from_channel(self, handler):
+		members = self.channels.get(getattr(handler, "channel", None))
+		if members != None and members.get(handler.id_) is handler:
+			del members[handler.id_]
+
+
+	# One thread pings all peers, peers that did not send anything within
+	# timeout are evicted
+	def start_heartbeat(self, interval=HEARTBEAT_INTERVAL, timeout=HEARTBEAT_TIMEOUT):
+		self.heartbeat_interval = interval
+		self.heartbeat_timeout = timeout
+		thread = Thread(target=self._heartbeat)
+		thread.daemon = True
+		thread.start()
+
+
+	def _heartbeat(self):
+		while True:
+			time.sleep(self.heartbeat_interval)
+			now = time.monotonic()
+			with self.lock:
+				handlers = list(self.peers.values())
+			for handler in handlers:
+				if not handler.heartbeat:
+					continue
+				if now - handler.last_seen > self.heartbeat_timeout:
+					handler.evict()
+				else:
+					try:
+						handler.send({"ping" : now}, META_ROUTE)
+					except RuntimeError:
+						pass
+
+
+	def detach(self, token, id_, state, timeout):
+		with self.lock:
+			self._expire_sessions()
+			# Only the latest session of an id can be resumed
+			self.sessions.pop(self.detached.get(id_), None)
+			self.sessions[token] = (id_, state, time.monotonic() + timeout)
+			self.detached[id_] = token
+
+
+	# (id, state) of the session or None if it does not exist (anymore)
+	def resume(self, token):
+		with self.lock:
+			self._expire_sessions()
+			session = self.sessions.pop(token, None)
+			if session == None:
+				return None
+			del self.detached[session[0]]
+			if session[0] in self.peers:
+				return None
+			return session[0], session[1]
+
 
+	def is_detached(self, id_):
+		with self.lock:
+			self._expire_sessions()
+			return id_ in self.detached
+
+
+	def _expire_sessions(self):
+		now = time.monotonic()
+		for token, session in list(self.sessions.items()):
+			if session[2] <= now:
+				del self.sessions[token]
+				if self.detached.get(session[0]) == token:
+					del self.detached[session[0]]
+
+
+	def in_channel(self, channel):
+		with self.lock:
+			return list(self.channels.get(channel, {}).values())
+
+
+	def get(self, id_, default=None):
+		return self.peers.get(id_, default)
+
+
+	def __getitem__(self, id_):
+		return self.peers[id_]
+
+
+	def __contains__(self, id_):
+		return id_ in self.peers
+
+
+	def __iter__(self):
+		with self.lock:
+			return iter(list(self.peers))
+
+
+	def __len__(self):
+		return len(self.peers)
 
 
 class Server(WebSocket, Shared):
-	def setup(self, routes, websockets, debug=False):
-		routes[PIPE_ROUTE] = ServerPipe()
-		super().setup(routes, debug=debug)
-		self.websockets = websockets
-		self._last_websockets = self.websockets.copy()
-		self._peers = {}
+	__slots__ = ("registry", "id_", "session_timeout", "session_token", "session_state",
+		"evicted")
+
+	# Outgoing messages are queued (see OutboundQueue) unless
+	# outbound_high_watermark is 0
+	def setup(self, routes, registry, debug=False, compression_level=COMPRESSION_LEVEL,
+		compression_threshold=COMPRESSION_THRESHOLD,
+		outbound_high_watermark=OUTBOUND_HIGH_WATERMARK,
+		outbound_low_watermark=OUTBOUND_LOW_WATERMARK, outbound_policies={},
+		session_timeout=SESSION_TIMEOUT, route_cache=None):
+		super().setup(registry.get_route_table(routes), debug=debug,
+			compression_level=compression_level,
+			compression_threshold=compression_threshold, route_cache=route_cache)
+		if outbound_high_watermark > 0:
+			policies = dict(outbound_policies)
+			policies[META_ROUTE] = NEVER_DROP
+			self.outbound = OutboundQueue(self, outbound_high_watermark,
+				outbound_low_watermark, policies)
+		self.registry = registry
 		id_ = binascii.b2a_hex(os.urandom(PIPE_ID_LENGTH // 2)).decode()
-		while id_ in self.peers:
+		while id_ in self.registry or self.registry.is_detached(id_):
 			id_ = binascii.b2a_hex(os.urandom(PIPE_ID_LENGTH // 2)).decode()
 		self.id_ = id_
+		self.session_timeout = session_timeout
+		self.session_token = binascii.b2a_hex(os.urandom(SESSION_TOKEN_LENGTH // 2)).decode()
+		# State of a resumed session, restored once the handshake is done
+		self.session_state = None
+		self.evicted = False
 		self.override_methods()
 
 
 	@property
 	def peers(self):
-		if self.websockets != self._last_websockets:
-			if self.debug:
-				Logging.info("Rebuilding peers. (currently connected: %i)" %
-					len(self.websockets))
-			self._peers = {}
-			for websocket in self.websockets:
-				self._peers[self.websockets[websocket].id_] = self.websockets[websocket]
-			self._last_websockets = self.websockets.copy()
-		return self._peers
+		return self.registry
 
 
 	def post_opened(self):
-		self.send({"routes" : self.exchange_routes}, META_ROUTE)
+		token = get_header(self.environ, SESSION_HEADER)
+		session = self.registry.resume(token) if token != None else None
+		identity = get_header(self.environ, IDENTITY_HEADER)
+		if session != None:
+			self.id_, self.session_state = session
+			if self.debug:
+				Logging.info("Resumed session of '%s'." % self.id_)
+		elif identity:
+			self.id_ = get_identity_id(identity)
+		# The newest connection of an identity wins (the old one is most likely
+		# dead but has not timed out yet)
+		old = self.registry.get(self.id_)
+		if old != None and old is not self:
+			Logging.warning("'%s' connected again, closing its old connection." % self.id_)
+			old.close(code=CLOSE_REPLACED, reason="replaced by a newer connection")
+		self.registry.add(self)
+		meta = {"codecs" : CODECS, "compressions" : COMPRESSIONS,
+			"session" : {"token" : self.session_token, "resumed" : session != None}}
+		hashes = get_header(self.environ, ROUTES_HEADER)
+		# Clients without the header only understand full exchange maps
+		if hashes == None:
+			meta["routes"] = self.exchange_routes
+		else:
+			hashes = hashes.split(",")
+			meta["routes_hash"] = self.routes_hash
+			if self.routes_hash not in hashes[1:]:
+				meta["routes"] = compact_exchange_map(self.exchange_routes)
+			if self.route_cache != None:
+				exchange_maps = self.route_cache.get(hashes[0])
+				if exchange_maps != None:
+					self.cached_peer_routes = (hashes[0], ) + exchange_maps
+					meta["routes_known"] = True
+		if self.registry.heartbeat_interval > 0:
+			meta["heartbeat"] = {"interval" : self.registry.heartbeat_interval,
+				"timeout" : self.registry.heartbeat_timeout}
+		self.send(meta, META_ROUTE)
+
+
+	# Shutting the socket down makes ws4py close the connection right away,
+	# sessions of evicted peers can't be resumed
+	def evict(self):
+		if self.evicted:
+			return
+		self.evicted = True
+		Logging.warning("'%s' did not answer for %ds, evicting it." % (self.id_,
+			time.monotonic() - self.last_seen))
+		try:
+			self.sock.shutdown(socket.SHUT_RDWR)
+		except (OSError, AttributeError):
+			pass
+
+
+	# Only connections that dropped might come back
+	def keeps_session(self, code):
+		return self.session_timeout > 0 and not self.evicted and code not in CLEAN_CLOSE_CODES
+
+
+	def closed(self, code, reason):
+		if self.keeps_session(code):
+			self.registry.detach(self.session_token, self.id_, self.suspend(),
+				self.session_timeout)
+		self.registry.remove(self)
+		if self.outbound != None:
+			self.outbound.stop()
+
+
+	# State kept for a resumable session, see Server.setup
+	def suspend(self):
+		return None
 
 
 class Client(WebSocketClient, Shared):
-	def setup(self, routes, debug=False):
+	__slots__ = ("identity", "auto_reconnect", "reconnect_delay", "reconnect_max_delay",
+		"session_token", "stopped", "heartbeat_timeout", "init_args")
+
+	# Every reconnect sets the socket up again with the same arguments
+	def __init__(self, url, protocols=None, extensions=None, heartbeat_freq=None,
+		ssl_options=None, headers=None, exclude_headers=None):
+		self.init_args = {"protocols" : protocols, "extensions" : extensions,
+			"heartbeat_freq" : heartbeat_freq, "ssl_options" : ssl_options,
+			"headers" : list(headers or ()), "exclude_headers" : exclude_headers}
+		super().__init__(url, protocols=protocols, extensions=extensions,
+			heartbeat_freq=heartbeat_freq, ssl_options=ssl_options,
+			headers=list(headers or ()), exclude_headers=exclude_headers)
+
+	# With a batch_window (seconds) > 0 outgoing messages are coalesced into
+	# batches of up to batch_max_bytes. With reconnect run_forever reconnects
+	# (and resumes the session if the server still has it) until stop is called.
+	# Clients with an identity keep their pipe id even if their session is gone.
+	def setup(self, routes, debug=False, compression_level=COMPRESSION_LEVEL,
+		compression_threshold=COMPRESSION_THRESHOLD, batch_window=0,
+		batch_max_bytes=BATCH_MAX_BYTES, reconnect=False, reconnect_delay=RECONNECT_DELAY,
+		reconnect_max_delay=RECONNECT_MAX_DELAY, identity=None, route_cache=None):
 		routes[PIPE_ROUTE] = DummyPipe()
-		super().setup(routes, debug=debug)
-
+		super().setup(routes, debug=debug, compression_level=compression_level,
+			compression_threshold=compression_threshold, route_cache=route_cache)
+		if batch_window > 0:
+			self.batch = SendBatch(self, batch_window, max_bytes=batch_max_bytes)
+		self.identity = identity
+		self.auto_reconnect = reconnect
+		self.reconnect_delay = reconnect_delay
+		self.reconnect_max_delay = reconnect_max_delay
+		self.session_token = None
+		self.extra_headers.extend(self.get_headers())
+		self.stopped = False
+		self.heartbeat_timeout = None
 		self.override_methods()
 
+
+	def run_forever(self):
+		while True:
+			super().run_forever()
+			if not self.auto_reconnect or self.stopped:
+				return
+			self.reconnect()
+
+
+	# Has to be called after reset_peer, it sets up cached_peer_routes
+	def get_headers(self):
+		headers = []
+		if self.identity != None:
+			headers.append((IDENTITY_HEADER, self.identity))
+		if self.session_token != None:
+			headers.append((SESSION_HEADER, self.session_token))
+		hashes = self.routes_hash
+		if self.route_cache != None:
+			hash_ = self.route_cache.get_peer(self.url)
+			exchange_maps = self.route_cache.get(hash_)
+			if exchange_maps != None:
+				self.cached_peer_routes = (hash_, ) + exchange_maps
+				hashes += "," + hash_
+		headers.append((ROUTES_HEADER, hashes))
+		return headers
+
+
+	# With reconnect a failed first attempt is retried like a dropped connection
+	def connect_with_retry(self):
+		try:
+			self.connect()
+		except (OSError, HandshakeError) as e:
+			if not self.auto_reconnect:
+				raise
+			Logging.warning("Connecting failed: %s", e)
+			self.reconnect()
+
+
+	# Jittered exponential backoff, a new socket is set up for every attempt
+	def reconnect(self):
+		delay = self.reconnect_delay
+		while not self.stopped:
+			time.sleep(random.uniform(delay / 2, delay))
+			init_args = dict(self.init_args, headers=list(self.init_args["headers"]))
+			WebSocketClient.__init__(self, self.url, **init_args)
+			self.reset_peer()
+			self.extra_headers.extend(self.get_headers())
+			try:
+				self.connect()
+				return
+			except (OSError, HandshakeError) as e:
+				if self.debug:
+					Logging.warning("Reconnecting failed: %s", e)
+			delay = min(delay * 2, self.reconnect_max_delay)
+
+
+	# The connection is dropped (and reconnected) if the server's pings stop
+	def watch_heartbeat(self, timeout):
+		watching = self.heartbeat_timeout != None
+		self.heartbeat_timeout = timeout
+		if not watching:
+			thread = Thread(target=self._watch_heartbeat)
+			thread.daemon = True
+			thread.start()
+
+
+	def _watch_heartbeat(self):
+		while not self.stopped:
+			time.sleep(self.heartbeat_timeout / 4)
+			if not self.terminated and time.monotonic() - self.last_seen > self.heartbeat_timeout:
+				Logging.warning("Server did not send anything for %ds, dropping the connection." %
+					self.heartbeat_timeout)
+				try:
+					self.sock.shutdown(socket.SHUT_RDWR)
+				except (OSError, AttributeError):
+					pass
+
+
+	# Closes the connection for good (ws4py calls close itself when the
+	# server closes the connection)
+	def stop(self):
+		self.stopped = True
+		self.close()
+
+
+	# Messages sent while reconnecting are lost
+	def write(self, message, route):
+		try:
+			super().write(message, route)
+		except (OSError, RuntimeError):
+			if not self.auto_reconnect:
+				raise
+
+
+	def closed(self, code, reason):
+		if code == CLOSE_REPLACED:
+			Logging.warning("Connection was replaced by a newer one.")
+			self.stopped = True
+		if self.batch != None and (self.stopped or not self.auto_reconnect):
+			self.batch.stop()
+
 	def pipe(self, data, route, id_, indexed_dict=False):
+		start = time.perf_counter()
+		try:
+			message = pack_piped_message(data,
+				self.peer_reverse_exchange_routes[PIPE_ROUTE],
+				self.peer_reverse_exchange_routes[route], id_,
+				indexed_dict=indexed_dict, codec=self.codec,
+				compression=self.get_compression())
+		except KeyError:
+			Logging.warning("'%s' does not exist." % route)
+		else:
+			self.send_packed(message, PIPE_ROUTE, time.perf_counter() - start)
+
+
+	# Pipes the same data to multiple peers, the payload is only encoded once
+	def multicast(self, data, route, ids, indexed_dict=False):
 		try:
-			self.send(pack_pipe_src_message(data,
-				self.peer_reverse_exchange_routes[route], id_, debug=self.debug),
-				PIPE_ROUTE, indexed_dict=indexed_dict)
+			exchange_route = self.peer_reverse_exchange_routes[route]
+			metadata = create_metadata(bytes, self.peer_reverse_exchange_routes[PIPE_ROUTE])
 		except KeyError:
 			Logging.warning("'%s' does not exist." % route)
+			return
+		data, data_type = prepare_data(data, codec=self.codec)
+		data, compressed = compress_data(data, self.get_compression())
+		for id_ in ids:
+			self.send_packed(b"".join((metadata, create_pipe_src_metadata(data_type,
+				exchange_route, id_, indexed_dict=indexed_dict, compressed=compressed), data)),
+				PIPE_ROUTE)
 
 
-	def peer_unavaliable(self, peer, handler):
+	def peer_unavaliable(self, peer):
 		pass
@@ -1,9 +1,13 @@
 from __future__ import print_function
-from time import strftime
-from inspect import getmodule, stack, currentframe, getframeinfo
+from time import strftime, time
+from sys import _getframe
 from sys import stderr
 from sys import stdout
-from threading import current_thread
+from threading import current_thread, Thread, Condition
+from collections import deque
+import atexit
+import json
+import os
 
 try:
 	import sublime
@@ -56,64 +60,187 @@ LIGHT_BLUE = "\033[94m"
 LIGHT_MAGENTA = "\033[95m"
 LIGHT_CYAN = "\033[96m"
 
-CACHED_MODULES = {}
-
-# If the stack becomes too complex to figure out a caller we go through and assume the first valid module is the caller.
-# This works reasonably well but isn't 100% accurate and will only happen if the caller is a thread.
-def print_out(message, color, file):
-	stack_ = stack()
-	# Interestingly the if statement below is not executed when excepting KeyboardInterrupts. Weird.
-	# To prevent a crash we assume the module's name is 'Unknown'
-	module = "Unknown"
-	if getmodule(stack_[2][0]) == None:
-		for i in stack_[2:]:
-			if getmodule(i[0]) != None:
-				try:
-					module = CACHED_MODULES[i[0].f_code]
-				except KeyError:
-					module = getmodule(i[0]).__name__
-					CACHED_MODULES[i[0].f_code] = module
-	else:
-		try:
-			module = CACHED_MODULES[stack_[2][0].f_code]
-		except KeyError:
-			module = getmodule(stack_[2][0]).__name__
-			CACHED_MODULES[stack_[2][0].f_code] = module
-	if not print_fallback:
-		# Constants not used for performance reasons
-		# String is split so that lookup speed is improved
-		print("[\033[94m\033[40mfl0w\033[0m\033[0m]\033[96m "
-			"%s\033[0m:%i → %s%s\033[0m" % (
-			module, stack_[2][0].f_lineno, color, message), 
-		file=file)
-		file.flush()
-	else:
-		print("[fl0w] %s:%i → %s" % (module, 
-			stack_[2][0].f_lineno, message))
-
-def info(message, color=""):
-	print_out(message, color, stdout)
-
-
-def header(message):
-	print_out(message, MAGENTA, stdout)
-
-
-def warning(message):
-	print_out(message, YELLOW, stderr)
-
-
-def error(message):
-	print_out(message, RED, stderr)
-
-
-def success(message):
-	print_out(message, GREEN, stdout)
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVELS = {"debug" : DEBUG, "info" : INFO, "warning" : WARNING, "error" : ERROR}
+
+# Messages below this level are dropped before the caller is looked up
+level = DEBUG
+
+
+def set_level(level_):
+	global level
+	level = LEVELS[level_] if type(level_) is str else level_
+
+
+def is_enabled(level_):
+	return level_ >= level
+
+
+LEVEL_NAMES = {DEBUG : "debug", INFO : "info", WARNING : "warning", ERROR : "error"}
+
+
+# Records are written by a background thread so a slow terminal or pipe never
+# stalls the calling thread. Everything that is pending is written as one batch
+# and every file is flushed once per batch. If more than max_pending records
+# are waiting, new ones are dropped and counted.
+class Writer:
+	def __init__(self, max_pending=10000):
+		self.max_pending = max_pending
+		self.records = deque()
+		self.dropped = 0
+		self.writing = False
+		self.condition = Condition()
+		self.log_file = None
+		self.log_file_path = None
+		self.max_bytes = 0
+		self.backups = 0
+		thread = Thread(target=self._write)
+		thread.daemon = True
+		thread.start()
+
+
+	def put(self, record):
+		with self.condition:
+			if len(self.records) >= self.max_pending:
+				self.dropped += 1
+			else:
+				self.records.append(record)
+				self.condition.notify()
+
+
+	# Blocks until all pending records have been written
+	def flush(self):
+		with self.condition:
+			while self.records or self.writing:
+				self.condition.wait()
+
+
+	def set_log_file(self, path, max_bytes=2**20, backups=3):
+		with self.condition:
+			while self.writing:
+				self.condition.wait()
+			if self.log_file != None:
+				self.log_file.close()
+			self.log_file_path = path
+			self.max_bytes = max_bytes
+			self.backups = backups
+			self.log_file = open(path, "a") if path != None else None
+
+
+	def _rotate(self):
+		self.log_file.close()
+		for i in range(self.backups - 1, 0, -1):
+			if os.path.exists("%s.%d" % (self.log_file_path, i)):
+				os.replace("%s.%d" % (self.log_file_path, i), "%s.%d" % (self.log_file_path, i + 1))
+		if self.backups > 0:
+			os.replace(self.log_file_path, "%s.1" % self.log_file_path)
+		self.log_file = open(self.log_file_path, "w")
+
+
+	def _write(self):
+		while True:
+			with self.condition:
+				while not self.records:
+					self.condition.wait()
+				records = self.records
+				self.records = deque()
+				dropped = self.dropped
+				self.dropped = 0
+				self.writing = True
+			if dropped:
+				records.append((time(), WARNING, __name__, 0, current_thread().name,
+					"%d log messages were dropped." % dropped, YELLOW, stderr))
+			files = set()
+			try:
+				for record in records:
+					time_, level_, module, line, thread, message, color, file = record
+					if not print_fallback:
+						# Constants not used for performance reasons
+						# String is split so that lookup speed is improved
+						file.write("[\033[94m\033[40mfl0w\033[0m\033[0m]\033[96m "
+							"%s\033[0m:%i → %s%s\033[0m\n" % (
+							module, line, color, message))
+						files.add(file)
+					else:
+						print("[fl0w] %s:%i → %s" % (module, line, message))
+					if self.log_file != None:
+						self.log_file.write(json.dumps({"time" : time_,
+							"level" : LEVEL_NAMES[level_], "module" : module,
+							"line" : line, "thread" : thread, "message" : message}) + "\n")
+				for file in files:
+					file.flush()
+				if self.log_file != None:
+					self.log_file.flush()
+					if self.max_bytes > 0 and self.log_file.tell() >= self.max_bytes:
+						self._rotate()
+			except (OSError, ValueError):
+				pass
+			with self.condition:
+				self.writing = False
+				self.condition.notify_all()
+
+
+writer = Writer()
+atexit.register(writer.flush)
+
+
+def set_log_file(path, max_bytes=2**20, backups=3):
+	writer.set_log_file(path, max_bytes=max_bytes, backups=backups)
+
+
+def flush():
+	writer.flush()
+
+
+# Messages are only formatted (message % args) if they are actually printed.
+# The caller is the frame that called info, warning, ... (depth 2), its
+# module name is read from the frame's globals.
+def print_out(message, args, level_, color, file):
+	if args:
+		message = message % args
+	frame = _getframe(2)
+	writer.put((time(), level_, frame.f_globals.get("__name__", "Unknown"),
+		frame.f_lineno, current_thread().name, message, color, file))
+
+
+def debug(message, *args, color=""):
+	if level <= DEBUG:
+		print_out(message, args, DEBUG, color, stdout)
+
+
+def info(message, *args, color=""):
+	if level <= INFO:
+		print_out(message, args, INFO, color, stdout)
+
+
+def header(message, *args):
+	if level <= INFO:
+		print_out(message, args, INFO, MAGENTA, stdout)
+
+
+def warning(message, *args):
+	if level <= WARNING:
+		print_out(message, args, WARNING, YELLOW, stderr)
+
+
+def error(message, *args):
+	if level <= ERROR:
+		print_out(message, args, ERROR, RED, stderr)
+
+
+def success(message, *args):
+	if level <= INFO:
+		print_out(message, args, INFO, GREEN, stdout)
 
 
 if __name__ == "__main__":
 	import sys
 	info("Hi!", color=UNDERLINE+BACKGROUND_GREEN+RED)
+	debug("Lazily formatted: %d", 42)
 	header("This is a header")
 	warning("This is a warning")    # > stderr
 	error("This is an error")       # > stderr
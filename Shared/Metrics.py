@@ -0,0 +1,123 @@
+import Logging
+
+import time
+import threading
+
+IN = "in"
+OUT = "out"
+
+# Bucket i counts durations in [2^(i-1), 2^i) microseconds, bucket 0 < 1us
+BUCKETS = 32
+
+
+class Histogram:
+	def __init__(self):
+		self.buckets = [0] * BUCKETS
+		self.count = 0
+		self.total = 0.0
+		self.max = 0.0
+
+
+	def add(self, seconds):
+		microseconds = seconds * 1000000
+		self.buckets[min(int(microseconds).bit_length(), BUCKETS - 1)] += 1
+		self.count += 1
+		self.total += microseconds
+		if microseconds > self.max:
+			self.max = microseconds
+
+
+	# Upper bound of the bucket the percentile falls into
+	def percentile(self, percentile):
+		if self.count == 0:
+			return 0
+		rank = self.count * percentile / 100
+		seen = 0
+		for i, count in enumerate(self.buckets):
+			seen += count
+			if seen >= rank:
+				return min(2 ** i, self.max)
+		return self.max
+
+
+	def get(self):
+		return {"count" : self.count,
+			"mean_us" : self.total / self.count if self.count else 0,
+			"p50_us" : self.percentile(50), "p99_us" : self.percentile(99),
+			"max_us" : self.max, "buckets" : list(self.buckets)}
+
+
+class RouteMetrics:
+	def __init__(self):
+		self.messages = 0
+		self.bytes = 0
+		# Encoding for sent, decoding for received messages
+		self.codec = Histogram()
+		# Time spent in route.run (received messages only)
+		self.handler = Histogram()
+
+
+	def get(self):
+		return {"messages" : self.messages, "bytes" : self.bytes,
+			"codec" : self.codec.get(), "handler" : self.handler.get()}
+
+
+# Counters are kept per (direction, route) and shared by all handlers of a
+# process.
+class Metrics:
+	def __init__(self):
+		self.enabled = True
+		self.started = time.time()
+		self.routes = {IN : {}, OUT : {}}
+		self.lock = threading.Lock()
+
+
+	def record(self, direction, route, length, codec_time=None, handler_time=None):
+		with self.lock:
+			try:
+				metrics = self.routes[direction][route]
+			except KeyError:
+				metrics = self.routes[direction][route] = RouteMetrics()
+			metrics.messages += 1
+			metrics.bytes += length
+			if codec_time != None:
+				metrics.codec.add(codec_time)
+			if handler_time != None:
+				metrics.handler.add(handler_time)
+
+
+	def get(self):
+		with self.lock:
+			return {"uptime" : time.time() - self.started,
+				"routes" : {direction : {route : metrics.get()
+				for route, metrics in routes.items()}
+				for direction, routes in self.routes.items()}}
+
+
+	# Logs messages/s and bytes/s per route every interval seconds
+	def start_dump(self, interval):
+		thread = threading.Thread(target=self._dump, args=(interval, ))
+		thread.daemon = True
+		thread.start()
+
+
+	def _dump(self, interval):
+		last = self.get()
+		while True:
+			time.sleep(interval)
+			current = self.get()
+			elapsed = current["uptime"] - last["uptime"]
+			for direction in (IN, OUT):
+				for route, metrics in sorted(current["routes"][direction].items()):
+					previous = last["routes"][direction].get(route, {"messages" : 0, "bytes" : 0})
+					messages = metrics["messages"] - previous["messages"]
+					if messages:
+						Logging.info("%s %-12s %8.1f msg/s %10.1f B/s  codec p50 %dus p99 %dus  handler p50 %dus p99 %dus",
+							direction, route, messages / elapsed,
+							(metrics["bytes"] - previous["bytes"]) / elapsed,
+							metrics["codec"]["p50_us"], metrics["codec"]["p99_us"],
+							metrics["handler"]["p50_us"], metrics["handler"]["p99_us"])
+			last = current
+
+
+metrics = Metrics()
@@ -6,6 +6,7 @@ import struct
 import socket
 import fcntl
 import subprocess
+import uuid
 
 class HostnameNotChangedError(PermissionError):
 	def __init__(self):
@@ -60,6 +61,12 @@ def get_hostname():
 	return platform.uname().node
 
 
+# Stable across restarts and hostname changes of this machine, name tells
+# apart several clients running on it
+def get_identity(name):
+	return "%s@%012x" % (name, uuid.getnode())
+
+
 def get_ip_address(ifname=None):
 	if ifname:
 		if is_linux():
@@ -15,8 +15,8 @@ if shared_path not in path:
 import sublime
 import sublime_plugin
 
-from Highway import Client, Route, Pipe, DummyPipe
-from Utils import get_hostname
+from Highway import Client, Route, Pipe, DummyPipe, RouteCache, COMPRESSION_THRESHOLD
+from Utils import get_hostname, get_identity
 
 from SublimeMenu import *
 import Logging
@@ -59,8 +59,11 @@ class Target:
 
 
 class Fl0wClient(Client):
-	def setup(self, routes, fl0w, debug=False):
-		super().setup(routes, debug=debug)
+	def setup(self, routes, fl0w, debug=False, compression_level=2, identity=None,
+		route_cache=None):
+		super().setup(routes, debug=debug, compression_level=compression_level,
+			compression_threshold=COMPRESSION_THRESHOLD, reconnect=True, identity=identity,
+			route_cache=route_cache)
 		self.fl0w = fl0w
 
 
@@ -68,6 +71,10 @@ class Fl0wClient(Client):
 		self.fl0w.connected = True
 		if self.fl0w.debug:
 			Logging.info("Connection ready!")
+		# The server restored channel and subscriptions
+		if self.resumed:
+			set_status("Connection resumed '%s'" % self.fl0w.folder, self.fl0w.window)
+			return
 		# Enlist on editor channel
 		self.send({"channel" : CHANNEL, "name" : get_hostname()}, "subscribe")
 		# Subscribe to controller channel
@@ -75,9 +82,13 @@ class Fl0wClient(Client):
 
 
 	def closed(self, code, reason):
-		self.fl0w.invoke_disconnect()
+		super().closed(code, reason)
 		if self.fl0w.debug:
 			Logging.info("Connection closed: %s (%s)" % (reason, code))
+		if self.stopped:
+			self.fl0w.invoke_disconnect()
+		else:
+			set_status("Connection lost, reconnecting '%s'" % self.fl0w.folder, self.fl0w.window)
 
 
 	def peer_unavaliable(self, peer):
@@ -251,6 +262,8 @@ class Fl0wClient(Client):
 				meta_text = ""
 				if "exit_code" in data:
 					meta_text += "Program finished with exit code: %d\n" % data["exit_code"]				
+				if data.get("dropped"):
+					meta_text += "%d bytes of output were dropped (connection too slow).\n" % data["dropped"]
 				self.lock.acquire()
 				# try/except is faster than an explicit if as long as the 
 				# condition is not met
@@ -302,6 +315,11 @@ class Fl0wClient(Client):
 class Fl0w:
 	def __init__(self, window, debug=False):
 		self.settings = sublime.load_settings("fl0w.sublime-settings")
+		# self.settings is replaced by the settings menu below
+		self.compression_level = self.settings.get("compression_level", 2)
+		# One identity (and thereby pipe id) per project folder
+		self.identity = self.settings.get("identity",
+			get_identity("editor:%s" % window.folders()[0]))
 		self.window = window
 		self.folder = window.folders()[0]
 		if self.folder != "/":
@@ -497,7 +515,9 @@ class Fl0w:
 				"list_programs" : Fl0wClient.ListPrograms(), "sensor" : Fl0wClient.Sensor(),
 				"std_stream" : Fl0wClient.StdStream(), "run_program" : Fl0wClient.RunProgram(),
 				"stop_programs" : Fl0wClient.StopPrograms()}, 
-				self, debug=True)
+				self, debug=True, compression_level=self.compression_level,
+				identity=self.identity,
+				route_cache=RouteCache(os.path.join(sublime.cache_path(), "fl0w_routes.json")))
 			self.ws.connect()
 			sublime.set_timeout_async(self.ws.run_forever, 0)
 			set_status("Connection opened '%s'" % self.folder, self.window)
@@ -519,7 +539,7 @@ class Fl0w:
 				if sensor_phantom.window.id() == self.window.id():
 					sensor_phantom.enabled = False
 			self.target = None
-			self.ws.close()
+			self.ws.stop()
 			set_status("Connection closed '%s'" % self.folder, self.window)
 			self.connected = False
 
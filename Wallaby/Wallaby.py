@@ -1,4 +1,5 @@
-from Highway import Route, Pipe, Client
+from Highway import (Route, Pipe, Client, RouteCache, COMPRESSION_LEVEL,
+	COMPRESSION_THRESHOLD, BATCH_MAX_BYTES)
 import Logging
 import Config
 import Utils
@@ -8,7 +9,11 @@ import time
 import os
 import sys
 import subprocess
+import select
+import codecs
+from collections import deque
 from random import randint
+from ctypes import cdll
 from _thread import start_new_thread
 import threading
 
@@ -38,6 +43,7 @@ class SensorReadout:
 	DIGITAL = 2
 	NAMED_MODES = {ANALOG : "analog", DIGITAL : "digital"}
 	MODES = tuple(NAMED_MODES.keys())
+	MIN_POLL_RATE = 0.1
 
 
 	def __init__(self, handler, poll_rate=0.5):
@@ -45,8 +51,22 @@ class SensorReadout:
 		self.handler = handler
 		self.peer_lock = threading.Lock()
 		self.peers = {}
-		self.readout_required = {SensorReadout.ANALOG : [],
-			SensorReadout.DIGITAL : []}
+		self.readout_required = {SensorReadout.ANALOG : set(),
+			SensorReadout.DIGITAL : set()}
+		# Ports without their own rate are read every poll_rate seconds
+		self.port_rates = {SensorReadout.ANALOG : {},
+			SensorReadout.DIGITAL : {}}
+		self.next_readouts = {SensorReadout.ANALOG : {},
+			SensorReadout.DIGITAL : {}}
+		self.values = {SensorReadout.ANALOG : {},
+			SensorReadout.DIGITAL : {}}
+		self.sent_values = {SensorReadout.ANALOG : {},
+			SensorReadout.DIGITAL : {}}
+		# None sends every readout, otherwise readouts are only sent if an
+		# analog value moved by more than the deadband or a digital one changed
+		self.deadband = None
+		self.force_send = False
+		self.wake_up = threading.Event()
 		self.generate_random_values = False
 		# Running on actual hardware?
 		if IS_WALLABY:
@@ -68,46 +88,68 @@ class SensorReadout:
 
 
 	def subscribe(self, port, mode, peer):
-		if port not in self.readout_required[mode]:
-			self.readout_required[mode].append(port)
-		if not peer in self.peers:
-			self.peer_lock.acquire()
-			self.peers[peer] = {SensorReadout.ANALOG : [],
-			SensorReadout.DIGITAL : []}
-			self.peer_lock.release()
-		self.peers[peer][mode].append(port)
+		with self.peer_lock:
+			if not peer in self.peers:
+				self.peers[peer] = {SensorReadout.ANALOG : set(),
+				SensorReadout.DIGITAL : set()}
+			self.peers[peer][mode].add(port)
+			if port not in self.readout_required[mode]:
+				self.readout_required[mode].add(port)
+				self.next_readouts[mode][port] = 0
+			# New subscribers need a readout even if nothing changed
+			self.force_send = True
+		self.wake_up.set()
 
 
 	def unsubscribe(self, port, mode, peer):
 		if peer in self.peers:
 			if port in self.peers[peer][mode]:
-				self.peer_lock.acquire()
-				del self.peers[peer][mode][self.peers[peer][mode].index(port)]
-				self.peer_lock.release()
+				with self.peer_lock:
+					self.peers[peer][mode].discard(port)
+					# Readouts are multicast to every peer in self.peers
+					if not any(self.peers[peer].values()):
+						del self.peers[peer]
 				self.determine_required_readouts()
 
 
 	def determine_required_readouts(self):
-		readout_required = {SensorReadout.ANALOG : [],
-			SensorReadout.DIGITAL : []}
-		self.peer_lock.acquire()
-		for peer in self.peers:
-			for mode in (SensorReadout.ANALOG, SensorReadout.DIGITAL):
-				for port in self.peers[peer][mode]:
-					if not port in readout_required[mode]:
-						readout_required[mode].append(port)
-		self.peer_lock.release()
-		self.readout_required = readout_required
+		readout_required = {SensorReadout.ANALOG : set(),
+			SensorReadout.DIGITAL : set()}
+		with self.peer_lock:
+			for peer in self.peers:
+				for mode in SensorReadout.MODES:
+					readout_required[mode] |= self.peers[peer][mode]
+			for mode in SensorReadout.MODES:
+				for port in self.readout_required[mode] - readout_required[mode]:
+					self.next_readouts[mode].pop(port, None)
+					self.values[mode].pop(port, None)
+					self.sent_values[mode].pop(port, None)
+			self.readout_required = readout_required
 
 
 	def unsubscribe_all(self, peer):
 		if peer in self.peers:
-			self.peer_lock.acquire()
-			del self.peers[peer]
-			self.peer_lock.release()
+			with self.peer_lock:
+				del self.peers[peer]
 			self.determine_required_readouts()
 
 
+	def set_poll_rate(self, poll_rate):
+		self.poll_rate = poll_rate
+		self.wake_up.set()
+
+
+	def set_port_rate(self, port, mode, rate):
+		with self.peer_lock:
+			if rate == None:
+				self.port_rates[mode].pop(port, None)
+			else:
+				self.port_rates[mode][port] = rate
+			if port in self.next_readouts[mode]:
+				self.next_readouts[mode][port] = 0
+		self.wake_up.set()
+
+
 	def __get_sensor_value(self, port, mode):
 		if mode == SensorReadout.ANALOG:
 			return self.wallaby_library.analog(port)
@@ -122,26 +164,51 @@ class SensorReadout:
 			return randint(0, 1)
 
 
+	def has_changed(self, port, mode, value):
+		if not port in self.sent_values[mode]:
+			return True
+		if mode == SensorReadout.ANALOG:
+			return abs(value - self.sent_values[mode][port]) > self.deadband
+		return value != self.sent_values[mode][port]
+
 
+	# Only ports that are due are read, without holding the lock so
+	# (un)subscribing never waits for the library. Every peer gets the same
+	# readout (latest value of all subscribed ports) which is encoded once.
 	def _sensor_fetcher(self):
 		while True:
-			current_values = {SensorReadout.ANALOG : {},
-			SensorReadout.DIGITAL : {}}
-			for mode in SensorReadout.MODES:
-				for port in self.readout_required[mode]:
-					current_values[mode][port] = self.get_sensor_value(port, mode)
-			self.peer_lock.acquire()
-			for peer in self.peers:
-				readouts = 0
-				response = {"analog" : {}, "digital" : {}}
-				for mode in SensorReadout.NAMED_MODES:
-					for port in self.peers[peer][mode]:
-						response[SensorReadout.NAMED_MODES[mode]][port] = current_values[mode][port]
-						readouts += 1
-				if readouts != 0:
-					self.handler.pipe(response, "sensor", peer)
-			self.peer_lock.release()
-			time.sleep(self.poll_rate)
+			self.wake_up.clear()
+			now = time.monotonic()
+			readout = None
+			with self.peer_lock:
+				due = [(port, mode) for mode in SensorReadout.MODES
+					for port in self.readout_required[mode] if self.next_readouts[mode][port] <= now]
+			values = [(port, mode, self.get_sensor_value(port, mode)) for port, mode in due]
+			with self.peer_lock:
+				send = self.force_send
+				self.force_send = False
+				for port, mode, value in values:
+					# Unsubscribed while it was read
+					if port not in self.readout_required[mode]:
+						continue
+					self.values[mode][port] = value
+					self.next_readouts[mode][port] = now + self.port_rates[mode].get(
+						port, self.poll_rate)
+					if self.deadband == None or self.has_changed(port, mode, value):
+						send = True
+				next_readout = now + self.poll_rate
+				for mode in SensorReadout.MODES:
+					for port in self.readout_required[mode]:
+						next_readout = min(next_readout, self.next_readouts[mode][port])
+				if send and len(self.peers) != 0:
+					readout = {}
+					for mode in SensorReadout.MODES:
+						self.sent_values[mode] = self.values[mode].copy()
+						readout[SensorReadout.NAMED_MODES[mode]] = self.sent_values[mode]
+					peers = list(self.peers)
+			if readout != None:
+				self.handler.multicast(readout, "sensor", peers)
+			self.wake_up.wait(max(0, next_readout - time.monotonic()))
 
 	@staticmethod
 	def valid_port(port, mode):
@@ -153,6 +220,8 @@ class SensorReadout:
 
 
 class Identify(Pipe):
+	blocking = True
+
 	def run(self, data, peer, handler):
 		Utils.play_sound(config.identify_sound)
 		if handler.debug:
@@ -160,6 +229,8 @@ class Identify(Pipe):
 
 
 class ListPrograms(Pipe):
+	blocking = True
+
 	def run(self, data, peer, handler):
 		programs = []
 		if os.path.isdir(PATH):
@@ -174,6 +245,7 @@ class ListPrograms(Pipe):
 
 class StopPrograms(Pipe):
 	NO_PROGRAMS_RUNNING = 1
+	blocking = True
 
 	def run(self, data, peer, handler):
 		if handler.debug:
@@ -205,12 +277,95 @@ class RunProgram(Pipe):
 					Logging.warning("Program '%s' not found." % data[:-1])
 
 	def stream_stdout(self, program, peer, handler):
-		# Poll process for new output until finished
-		for line in iter(program.stdout.readline, b""):
-			handler.pipe(line.decode(), "std_stream", peer)
+		stream = OutputStream(handler, peer)
+		fd = program.stdout.fileno()
+		chunk = bytearray()
+		deadline = None
+		# Output is collected into chunks that are sent once they are big or
+		# old enough instead of sending one message per line
+		while True:
+			timeout = None if deadline == None else max(0, deadline - time.monotonic())
+			if select.select([fd], [], [], timeout)[0]:
+				data = os.read(fd, OutputStream.CHUNK_SIZE - len(chunk))
+				if not data:
+					break
+				if deadline == None:
+					deadline = time.monotonic() + OutputStream.CHUNK_INTERVAL
+				chunk += data
+			if deadline != None and (len(chunk) >= OutputStream.CHUNK_SIZE or
+				time.monotonic() >= deadline):
+				stream.write(bytes(chunk))
+				chunk.clear()
+				deadline = None
+		if chunk:
+			stream.write(bytes(chunk))
 		program.wait()
+		stream.close()
 		exit_code = program.returncode if type(program.returncode) is int else -1
-		handler.pipe({"exit_code" : exit_code}, "std_stream", peer)
+		handler.pipe({"exit_code" : exit_code, "dropped" : stream.dropped},
+			"std_stream", peer)
+		if handler.debug and stream.dropped:
+			Logging.warning("Dropped %d bytes of output." % stream.dropped)
+
+
+# Sends output chunks from its own thread so a slow link never blocks the
+# reading side (and thereby the running program). If more than MAX_PENDING
+# bytes are waiting to be sent, new output is dropped and counted.
+class OutputStream:
+	CHUNK_SIZE = 4096
+	CHUNK_INTERVAL = 0.05
+	MAX_PENDING = 2**16
+	CONGESTED_INTERVAL = 0.1
+
+	def __init__(self, handler, peer):
+		self.handler = handler
+		self.peer = peer
+		self.chunks = deque()
+		self.pending = 0
+		self.dropped = 0
+		self.closed = False
+		self.condition = threading.Condition()
+		# Chunks may end in the middle of a multi-byte character
+		self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+		self.sender = threading.Thread(target=self._sender)
+		self.sender.daemon = True
+		self.sender.start()
+
+
+	def write(self, chunk):
+		with self.condition:
+			if self.pending + len(chunk) > OutputStream.MAX_PENDING:
+				self.dropped += len(chunk)
+			else:
+				self.chunks.append(chunk)
+				self.pending += len(chunk)
+				self.condition.notify()
+
+
+	# Blocks until everything that was not dropped has been sent
+	def close(self):
+		with self.condition:
+			self.closed = True
+			self.condition.notify()
+		self.sender.join()
+
+
+	# While the server reports the peer as congested output is held back and
+	# sent as one message later (or dropped once MAX_PENDING is reached)
+	def _sender(self):
+		while True:
+			with self.condition:
+				while (not self.chunks or self.peer in self.handler.congested_peers) and not self.closed:
+					self.condition.wait(OutputStream.CONGESTED_INTERVAL if self.chunks else None)
+				if not self.chunks:
+					break
+				chunk = b"".join(self.chunks)
+				self.chunks.clear()
+				self.pending = 0
+			self.handler.pipe(self.decoder.decode(chunk), "std_stream", self.peer)
+		tail = self.decoder.decode(b"", final=True)
+		if tail:
+			self.handler.pipe(tail, "std_stream", self.peer)
 
 
 class Sensor(Pipe):
@@ -219,15 +374,37 @@ class Sensor(Pipe):
 	{"subscribe" : {"analog" : [1, 2, 3], "digital" : [1, 2, 3]}}
 	{"unsubscribe" : {"analog" : [1, 2, 3], "digital" : [1, 2, 3]}}
 	{"poll_rate" : 10}
+	{"port_rates" : {"analog" : {1 : 0.1}, "digital" : {1 : null}}}
+	{"deadband" : 10}
+	{"deadband" : null}
 
 	<-
 	{"analog" : {1 : 1240}, "digital" : {1 : 0, 2 : 0}}
+	(Contains all ports subscribed by any peer)
 	"""
+	sensor_readout = None
+
 	def run(self, data, peer, handler):
 		if type(data) is dict:
 			if "poll_rate" in data:
-				if type(data["poll_rate"]) in (int, float) and data["poll_rate"] >= 0.1:
-					self.sensor_readout.poll_rate = data["poll_rate"]
+				if type(data["poll_rate"]) in (int, float) and data["poll_rate"] >= SensorReadout.MIN_POLL_RATE:
+					self.sensor_readout.set_poll_rate(data["poll_rate"])
+			if "port_rates" in data and type(data["port_rates"]) is dict:
+				for mode in SensorReadout.MODES:
+					rates = data["port_rates"].get(SensorReadout.NAMED_MODES[mode], {})
+					for port in rates:
+						try:
+							port_ = int(port)
+						except ValueError:
+							continue
+						rate = rates[port]
+						if SensorReadout.valid_port(port_, mode) and (rate == None or
+							(type(rate) in (int, float) and rate >= SensorReadout.MIN_POLL_RATE)):
+							self.sensor_readout.set_port_rate(port_, mode, rate)
+			if "deadband" in data:
+				if data["deadband"] == None or (type(data["deadband"]) in (int, float)
+					and data["deadband"] >= 0):
+					self.sensor_readout.deadband = data["deadband"]
 			for event in ("subscribe", "unsubscribe"):
 				if event in data:
 					for mode in ("analog", "digital"):
@@ -248,11 +425,15 @@ class Sensor(Pipe):
 				self.sensor_readout.unsubscribe_all(peer)
 
 
+	# Subscriptions outlive reconnects
 	def start(self, handler):
-		self.sensor_readout = SensorReadout(handler)
+		if self.sensor_readout == None:
+			self.sensor_readout = SensorReadout(handler)
 
 
 class Shutdown(Pipe):
+	blocking = True
+
 	def run(self, data, peer, handler):
 		try:
 			subprocess.check_output(["shutdown", "now"])
@@ -261,6 +442,8 @@ class Shutdown(Pipe):
 
 
 class Reboot(Pipe):
+	blocking = True
+
 	def run(self, data, peer, handler):
 		try:
 			subprocess.check_output(["reboot"])
@@ -282,6 +465,8 @@ class WhoAmI(Route):
 
 
 class Hostname(Pipe):
+	blocking = True
+
 	def run(self, data, peer, handler):
 		if type(data) is dict:
 			if "set" in data:
@@ -298,6 +483,8 @@ class Hostname(Pipe):
 
 
 class Processes(Pipe):
+	blocking = True
+
 	def run(self, data, peer, handler):
 		handler.pipe(
 			subprocess.check_output(["ps", "aux"]).decode().split("\n")[1:-1],
@@ -305,8 +492,13 @@ class Processes(Pipe):
 
 
 class Handler(Client):
-	def setup(self, routes, debug=False):
-		super().setup(routes, debug=debug)
+	def setup(self, routes, debug=False, compression_level=COMPRESSION_LEVEL,
+		compression_threshold=COMPRESSION_THRESHOLD, batch_window=0,
+		batch_max_bytes=BATCH_MAX_BYTES, reconnect=False, identity=None, route_cache=None):
+		super().setup(routes, debug=debug, compression_level=compression_level,
+			compression_threshold=compression_threshold, batch_window=batch_window,
+			batch_max_bytes=batch_max_bytes, reconnect=reconnect, identity=identity,
+			route_cache=route_cache)
 
 	def peer_unavaliable(self, peer):
 		if self.debug:
@@ -322,6 +514,24 @@ config.add(Config.Option("debug", False, validator=lambda x: True if True or Fal
 config.add(Config.Option("output_unbuffer", "stdbuf"))
 config.add(Config.Option("identify_sound", "Wallaby/identify.wav",
 	validator=lambda x: os.path.isfile(x)))
+config.add(Config.Option("compression_level", COMPRESSION_LEVEL,
+	validator=lambda x: type(x) is int and 0 <= x <= 9))
+config.add(Config.Option("compression_threshold", COMPRESSION_THRESHOLD,
+	validator=lambda x: type(x) is int and x >= 0))
+# Sensor updates and program output are coalesced for this many seconds (0 = off)
+config.add(Config.Option("batch_window", 0,
+	validator=lambda x: type(x) in (int, float) and x >= 0))
+config.add(Config.Option("batch_max_bytes", BATCH_MAX_BYTES,
+	validator=lambda x: type(x) is int and x > 0))
+config.add(Config.Option("reconnect", True, validator=lambda x: type(x) is bool))
+# Determines the pipe id. None derives it from the machine and the program
+# path (simulated Wallabies on one machine need different program paths),
+# False gets a new one on every connection.
+config.add(Config.Option("identity", None,
+	validator=lambda x: x in (None, False) or type(x) is str))
+# Exchange map of the server, None only keeps it in memory
+config.add(Config.Option("route_cache_path", "route_cache.json",
+	validator=lambda x: x == None or type(x) is str))
 
 try:
 	config = config.read_from_file(CONFIG_PATH)
@@ -339,8 +549,14 @@ try:
 		"whoami" : WhoAmI(), "run_program" : RunProgram(config.output_unbuffer),
 		"stop_programs" : StopPrograms(), "shutdown" : Shutdown(),
 		"reboot" : Reboot()},
-		debug=config.debug)
-	ws.connect()
+		debug=config.debug, compression_level=config.compression_level,
+		compression_threshold=config.compression_threshold,
+		batch_window=config.batch_window, batch_max_bytes=config.batch_max_bytes,
+		reconnect=config.reconnect,
+		identity=(Utils.get_identity("wallaby:%s" % PATH) if config.identity == None else
+			config.identity or None),
+		route_cache=RouteCache(config.route_cache_path))
+	ws.connect_with_retry()
 	ws.run_forever()
 except KeyboardInterrupt:
-	ws.close()
\ No newline at end of file
+	ws.stop()
\ No newline at end of file